@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Pushes a generated multi-million line gcode file through the queuing hook and reports the
+per line cost of the hook on top of the bare read loop. Needs OctoPrint installed:
+
+    python benchmarks/bench_gcode_hook.py --lines 5000000 --plugs 30
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from support import make_plug, make_plugin
+
+from octoprint.util.comm import gcode_command_for_cmd
+
+
+def _make_plugin(plug_count):
+        plugs = [
+                make_plug("http://192.168.1.%d:8080" % (10 + i % 4), i + 1, gcodeEnabled=i % 2 == 0)
+                for i in range(plug_count)
+        ]
+        plugin = make_plugin(plugs)
+        # count dispatches instead of scheduling power actions for every matched line
+        plugin.dispatched = 0
+
+        def _count(plug, source):
+                plugin.dispatched += 1
+
+        plugin._gcode_power_on = _count
+        plugin._gcode_power_off = _count
+        return plugin, plugs
+
+
+def _write_gcode(path, lines, plugs, power_every):
+        rnd = random.Random(0)
+        with open(path, "w") as f:
+                for n in range(lines):
+                        if power_every and n % power_every == 0:
+                                plug = plugs[rnd.randrange(len(plugs))]
+                                choice = rnd.randrange(3)
+                                if choice == 0:
+                                        f.write("M80 %s %s\n" % (plug["ip"].upper(), plug["idx"]))
+                                elif choice == 1:
+                                        f.write("M81 %s %s\n" % (plug["ip"], plug["idx"]))
+                                else:
+                                        f.write("@DOMOTICZON %s\n" % plug["idx"])
+                        elif n % 50 == 0:
+                                f.write("M104 S%d\n" % rnd.randrange(180, 240))
+                        else:
+                                f.write("G1 X%.3f Y%.3f E%.5f\n" % (rnd.random() * 200, rnd.random() * 200, rnd.random()))
+
+
+def _stream(path, hook):
+        start = time.perf_counter()
+        count = 0
+        with open(path) as f:
+                for line in f:
+                        cmd = line.rstrip("\n")
+                        gcode = gcode_command_for_cmd(cmd)
+                        if hook is not None:
+                                hook(None, "queuing", cmd, None, gcode)
+                        count += 1
+        return time.perf_counter() - start, count
+
+
+def run(lines=2000000, plugs=30, power_every=100000):
+        plugin, plug_list = _make_plugin(plugs)
+        fd, path = tempfile.mkstemp(suffix=".gcode")
+        os.close(fd)
+        try:
+                _write_gcode(path, lines, plug_list, power_every)
+                baseline, count = _stream(path, None)
+                hooked, _ = _stream(path, plugin.process_gcode)
+        finally:
+                os.remove(path)
+                plugin.on_shutdown()
+
+        return {
+                "benchmark": "process_gcode",
+                "lines": count,
+                "plugs": plugs,
+                "dispatched": plugin.dispatched,
+                "baseline_s": round(baseline, 4),
+                "hooked_s": round(hooked, 4),
+                "hook_ns_per_line": round((hooked - baseline) / count * 1e9, 1),
+        }
+
+
+def main():
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        parser.add_argument("--lines", type=int, default=2000000)
+        parser.add_argument("--plugs", type=int, default=30)
+        parser.add_argument("--power-every", type=int, default=100000,
+                            help="emit a power command every N lines, 0 disables them")
+        args = parser.parse_args()
+
+        print(json.dumps(run(args.lines, args.plugs, args.power_every), indent=2))
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the plugin's share of OctoPrint startup: importing the package and running its startup
+with no plug configured, each in a fresh interpreter that already imported what an OctoPrint
+server has loaded by the time it loads plugins. Needs OctoPrint installed:
+
+    python benchmarks/bench_import.py --runs 10
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# packages the plugin should not load before it has something to do with them
+DEFERRED = ("requests", "urllib3", "aiohttp", "asyncio")
+
+_PROBE = """
+import json, sys, time
+import {preload}
+
+before = set(sys.modules)
+start = time.perf_counter()
+import octoprint_domoticz
+imported = time.perf_counter()
+
+from support import make_plugin
+plugin = make_plugin([], pollInterval=0)
+started = time.perf_counter()
+plugin.on_shutdown()
+
+loaded = set(sys.modules) - before
+print(json.dumps({{
+        "import_ms": (imported - start) * 1000,
+        "startup_ms": (started - imported) * 1000,
+        "modules": len([name for name in loaded if not name.startswith(("octoprint_domoticz", "support"))]),
+        "deferred_loaded": sorted(name for name in {deferred!r} if name in loaded),
+}}))
+"""
+
+
+def _probe(preload):
+        code = _PROBE.format(preload=preload, deferred=DEFERRED)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([HERE, os.path.dirname(HERE), os.environ.get("PYTHONPATH", "")]))
+        output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def _median(values):
+        ordered = sorted(values)
+        return ordered[len(ordered) // 2]
+
+
+def run(runs=5, preload="octoprint.server"):
+        results = [_probe(preload) for _ in range(runs)]
+        return {
+                "benchmark": "import",
+                "runs": runs,
+                "preload": preload,
+                "import_ms": round(_median([r["import_ms"] for r in results]), 2),
+                "startup_ms": round(_median([r["startup_ms"] for r in results]), 2),
+                "modules": results[-1]["modules"],
+                "deferred_loaded": results[-1]["deferred_loaded"],
+        }
+
+
+def main():
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--preload", default="octoprint.server",
+                            help="modules imported before the plugin, octoprint.plugin for the bare minimum")
+        args = parser.parse_args()
+
+        print(json.dumps(run(args.runs, args.preload), indent=2))
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the parts of the Domoticz json.htm api used by the plugin.
+
+Implements type=command with param=switchlight and param=getdevices (single rid or the full
+device list), param=switchscene and param=getscenes for groups of devices and supports configurable latency, error rate, basic auth, a protection passcode
+and TLS. Run it standalone to point a development OctoPrint at it:
+
+    python benchmarks/fake_domoticz.py --port 8080 --devices 50 --latency 0.02
+"""
+from __future__ import absolute_import
+
+import argparse
+import base64
+import json
+import random
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeDomoticz(object):
+        def __init__(self, host="127.0.0.1", port=0, devices=10, scenes=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                     username="", password="", passcode="", certfile=None, keyfile=None, seed=None):
+                self.latency = latency
+                self.jitter = jitter
+                self.error_rate = error_rate
+                self.username = username
+                self.password = password
+                self.passcode = passcode
+                self.devices = {str(idx): "Off" for idx in range(1, devices + 1)}
+                # every scene groups all devices, like a "whole printer" group in Domoticz
+                self.scenes = {str(idx): list(self.devices) for idx in range(1, scenes + 1)}
+                self.requests = 0
+                self._random = random.Random(seed)
+                self._lock = threading.Lock()
+
+                self._server = ThreadingHTTPServer((host, port), self._handler_class())
+                self._server.daemon_threads = True
+                self.scheme = "http"
+                if certfile:
+                        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                        context.load_cert_chain(certfile, keyfile)
+                        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+                        self.scheme = "https"
+                self._thread = None
+
+        @property
+        def url(self):
+                host, port = self._server.server_address[:2]
+                return f"{self.scheme}://{host}:{port}"
+
+        def start(self):
+                self._thread = threading.Thread(target=self._server.serve_forever, name="fake-domoticz")
+                self._thread.daemon = True
+                self._thread.start()
+                return self
+
+        def stop(self):
+                self._server.shutdown()
+                self._server.server_close()
+
+        def __enter__(self):
+                return self.start()
+
+        def __exit__(self, *args):
+                self.stop()
+
+        def handle(self, query, authorization):
+                with self._lock:
+                        self.requests += 1
+                        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+                        fail = self.error_rate and self._random.random() < self.error_rate
+                if delay:
+                        time.sleep(delay)
+                if fail:
+                        return 500, {"status": "ERR", "message": "Injected error"}
+                if self.username and authorization != self._expected_authorization():
+                        return 401, {"status": "ERR", "message": "Unauthorized"}
+                if query.get("type") != "command":
+                        return 200, {"status": "ERR"}
+
+                param = query.get("param")
+                if param == "switchlight":
+                        idx = query.get("idx")
+                        if idx not in self.devices:
+                                return 200, {"status": "ERR", "message": "Error sending switch command, check device/hardware (idx=%s) !" % idx}
+                        if self.passcode and query.get("passcode") != self.passcode:
+                                return 200, {"status": "ERR", "message": "WRONG CODE"}
+                        if query.get("switchcmd") not in ("On", "Off", "Toggle"):
+                                return 200, {"status": "ERR"}
+                        with self._lock:
+                                if query["switchcmd"] == "Toggle":
+                                        self.devices[idx] = "Off" if self.devices[idx] == "On" else "On"
+                                else:
+                                        self.devices[idx] = query["switchcmd"]
+                        return 200, {"status": "OK", "title": "SwitchLight"}
+                elif param == "switchscene":
+                        idx = query.get("idx")
+                        if idx not in self.scenes:
+                                return 200, {"status": "ERR", "message": "Error sending scene command, check scene (idx=%s) !" % idx}
+                        if self.passcode and query.get("passcode") != self.passcode:
+                                return 200, {"status": "ERR", "message": "WRONG CODE"}
+                        if query.get("switchcmd") not in ("On", "Off"):
+                                return 200, {"status": "ERR"}
+                        with self._lock:
+                                for device in self.scenes[idx]:
+                                        self.devices[device] = query["switchcmd"]
+                        return 200, {"status": "OK", "title": "SwitchScene"}
+                elif param == "getscenes":
+                        return 200, {
+                                "status": "OK",
+                                "title": "Scenes",
+                                "result": [self._scene(idx) for idx in self.scenes],
+                        }
+                elif param == "getdevices":
+                        if "rid" in query:
+                                ids = [query["rid"]] if query["rid"] in self.devices else []
+                        else:
+                                ids = list(self.devices)
+                        return 200, {
+                                "status": "OK",
+                                "title": "Devices",
+                                "result": [self._device(idx) for idx in ids],
+                        }
+                return 200, {"status": "ERR"}
+
+        def _device(self, idx):
+                state = self.devices[idx]
+                return {
+                        "idx": idx,
+                        "Name": f"Device {idx}",
+                        "Type": "Light/Switch",
+                        "SwitchType": "On/Off",
+                        "Status": state,
+                        "Data": state,
+                }
+
+        def _scene(self, idx):
+                states = {self.devices[device] for device in self.scenes[idx]}
+                return {
+                        "idx": idx,
+                        "Name": f"Scene {idx}",
+                        "Type": "Group",
+                        "Status": states.pop() if len(states) == 1 else "Mixed",
+                }
+
+        def _expected_authorization(self):
+                token = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8")).decode("ascii")
+                return f"Basic {token}"
+
+        def _handler_class(self):
+                fake = self
+
+                class Handler(BaseHTTPRequestHandler):
+                        protocol_version = "HTTP/1.1"
+                        disable_nagle_algorithm = True
+
+                        def do_GET(self):
+                                url = urlparse(self.path)
+                                if url.path != "/json.htm":
+                                        self._send(404, {"status": "ERR"})
+                                        return
+                                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                                code, body = fake.handle(query, self.headers.get("Authorization"))
+                                self._send(code, body)
+
+                        def _send(self, code, body):
+                                payload = json.dumps(body).encode("utf-8")
+                                self.send_response(code)
+                                self.send_header("Content-Type", "application/json;charset=UTF-8")
+                                self.send_header("Content-Length", str(len(payload)))
+                                self.end_headers()
+                                self.wfile.write(payload)
+
+                        def log_message(self, format, *args):
+                                pass
+
+                return Handler
+
+
+def main():
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--devices", type=int, default=10)
+        parser.add_argument("--scenes", type=int, default=0, help="groups switching all devices at once")
+        parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+        parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added on top of the latency")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+        parser.add_argument("--username", default="")
+        parser.add_argument("--password", default="")
+        parser.add_argument("--passcode", default="")
+        parser.add_argument("--certfile")
+        parser.add_argument("--keyfile")
+        args = parser.parse_args()
+
+        server = FakeDomoticz(
+                host=args.host,
+                port=args.port,
+                devices=args.devices,
+                scenes=args.scenes,
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                username=args.username,
+                password=args.password,
+                passcode=args.passcode,
+                certfile=args.certfile,
+                keyfile=args.keyfile,
+        )
+        print(f"Fake Domoticz listening on {server.url} with {len(server.devices)} devices")
+        try:
+                server._server.serve_forever()
+        except KeyboardInterrupt:
+                pass
+        finally:
+                server._server.server_close()
+
+
+if __name__ == "__main__":
+        main()
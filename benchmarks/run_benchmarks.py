@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks of the plugin against local fake Domoticz servers, emitted as JSON.
+
+Measures switch toggle latency, status sweep throughput across many plugs on several servers,
+the per line cost of the gcode queuing hook and the plugin's import and startup time. Pass a previous result as --baseline to fail
+on regressions:
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --baseline bench.json --tolerance 0.25
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import bench_gcode_hook
+import bench_import
+from fake_domoticz import FakeDomoticz
+from support import make_plug, make_plugin
+
+# metrics where a higher value is a regression, everything else reported is informational
+LOWER_IS_BETTER = (
+        "toggle.p50_ms",
+        "toggle.p95_ms",
+        "status_sweep.sweep_ms",
+        "status_single.sweep_ms",
+        "gcode.hook_ns_per_line",
+        "import.import_ms",
+        "import.startup_ms",
+)
+
+
+def _percentile(samples, fraction):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _summary(samples):
+        return {
+                "count": len(samples),
+                "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+                "p50_ms": round(_percentile(samples, 0.5) * 1000, 3),
+                "p95_ms": round(_percentile(samples, 0.95) * 1000, 3),
+                "max_ms": round(max(samples) * 1000, 3),
+        }
+
+
+def _servers(args):
+        return [
+                FakeDomoticz(
+                        devices=args.plugs,
+                        latency=args.latency,
+                        username=args.username,
+                        password=args.password,
+                        passcode=args.passcode,
+                        certfile=args.certfile,
+                        keyfile=args.keyfile,
+                ).start()
+                for _ in range(args.servers)
+        ]
+
+
+def _plugs(servers, args):
+        return [
+                make_plug(
+                        server.url,
+                        idx,
+                        ignoreSSL=bool(args.certfile),
+                        username=args.username,
+                        password=args.password,
+                        passcode=args.passcode,
+                )
+                for server in servers
+                for idx in server.devices
+        ]
+
+
+def bench_toggle(plugin, plug, rounds):
+        samples = []
+        for n in range(rounds):
+                start = time.perf_counter()
+                if n % 2 == 0:
+                        plugin.turn_on(plug["ip"], plug["idx"], plug["ignoreSSL"], plug["username"], plug["password"], plug["passcode"])
+                else:
+                        plugin._switch_off(plug["ip"], plug["idx"], plug["ignoreSSL"], plug["username"], plug["password"], plug["passcode"])
+                samples.append(time.perf_counter() - start)
+        return _summary(samples)
+
+
+def bench_sweep(plugin, plugs, rounds):
+        samples = []
+        for _ in range(rounds):
+                plugin._state_cache.clear()
+                start = time.perf_counter()
+                plugin._sweep_statuses()
+                samples.append(time.perf_counter() - start)
+        result = _summary(samples)
+        result["plugs"] = len(plugs)
+        result["sweep_ms"] = result["p50_ms"]
+        result["plugs_per_s"] = round(len(plugs) / _percentile(samples, 0.5), 1)
+        return result
+
+
+def bench_single_checks(plugin, plugs, rounds):
+        samples = []
+        for _ in range(rounds):
+                plugin._state_cache.clear()
+                start = time.perf_counter()
+                for plug in plugs:
+                        plugin.check_status(plug["ip"], plug["idx"], plug["ignoreSSL"], plug["username"], plug["password"])
+                samples.append(time.perf_counter() - start)
+        result = _summary(samples)
+        result["plugs"] = len(plugs)
+        result["sweep_ms"] = result["p50_ms"]
+        result["plugs_per_s"] = round(len(plugs) / _percentile(samples, 0.5), 1)
+        return result
+
+
+def _flatten(results):
+        flat = {}
+        for section, values in results.items():
+                if isinstance(values, dict):
+                        for key, value in values.items():
+                                flat[f"{section}.{key}"] = value
+        return flat
+
+
+def compare(results, baseline, tolerance):
+        current = _flatten(results)
+        previous = _flatten(baseline)
+        regressions = []
+        for metric in LOWER_IS_BETTER:
+                if metric in current and previous.get(metric):
+                        ratio = current[metric] / previous[metric]
+                        if ratio > 1 + tolerance:
+                                regressions.append({"metric": metric, "baseline": previous[metric], "current": current[metric], "ratio": round(ratio, 3)})
+        return regressions
+
+
+def main():
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        parser.add_argument("--servers", type=int, default=3)
+        parser.add_argument("--plugs", type=int, default=20, help="plugs per server")
+        parser.add_argument("--latency", type=float, default=0.005, help="seconds of fake server latency")
+        parser.add_argument("--rounds", type=int, default=20)
+        parser.add_argument("--gcode-lines", type=int, default=500000)
+        parser.add_argument("--import-runs", type=int, default=5)
+        parser.add_argument("--request-rate", type=float, default=0,
+                            help="requests per second and server allowed by the plugin, 0 measures without limit")
+        parser.add_argument("--username", default="")
+        parser.add_argument("--password", default="")
+        parser.add_argument("--passcode", default="")
+        parser.add_argument("--certfile", help="serve https with this certificate")
+        parser.add_argument("--keyfile")
+        parser.add_argument("--output", help="write the results to this file instead of stdout")
+        parser.add_argument("--baseline", help="previous results to compare against")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+        args = parser.parse_args()
+
+        servers = _servers(args)
+        plugs = _plugs(servers, args)
+        plugin = make_plugin(plugs, stateTTL=0, requestRate=args.request_rate)
+        try:
+                results = {
+                        "environment": {
+                                "python": platform.python_version(),
+                                "platform": platform.platform(),
+                                "servers": args.servers,
+                                "plugs_per_server": args.plugs,
+                                "latency_s": args.latency,
+                                "tls": bool(args.certfile),
+                                "auth": bool(args.username),
+                                "request_rate": args.request_rate,
+                        },
+                        "toggle": bench_toggle(plugin, plugs[0], args.rounds),
+                        "status_sweep": bench_sweep(plugin, plugs, args.rounds),
+                        "status_single": bench_single_checks(plugin, plugs, max(1, args.rounds // 10)),
+                        "gcode": bench_gcode_hook.run(lines=args.gcode_lines),
+                        "import": bench_import.run(runs=args.import_runs),
+                        "upstream_requests": sum(server.requests for server in servers),
+                }
+        finally:
+                plugin.on_shutdown()
+                for server in servers:
+                        server.stop()
+
+        exit_code = 0
+        if args.baseline:
+                with open(args.baseline) as f:
+                        results["regressions"] = compare(results, json.load(f), args.tolerance)
+                exit_code = 1 if results["regressions"] else 0
+
+        output = json.dumps(results, indent=2)
+        if args.output:
+                with open(args.output, "w") as f:
+                        f.write(output + "\n")
+        else:
+                print(output)
+        sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+        main()
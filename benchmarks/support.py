@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the objects OctoPrint injects into the plugin, so the benchmarks can drive a
+plugin instance without a running server. OctoPrint itself still has to be installed.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_domoticz  # noqa: E402
+
+
+class Settings(object):
+        def __init__(self, values):
+                self._values = values
+
+        def get(self, path, **kwargs):
+                value = self._values
+                for key in path:
+                        value = value.get(key) if isinstance(value, dict) else None
+                return value
+
+        def get_boolean(self, path, **kwargs):
+                return bool(self.get(path))
+
+        def get_int(self, path, **kwargs):
+                return int(self.get(path))
+
+        def get_float(self, path, **kwargs):
+                return float(self.get(path))
+
+        def set(self, path, value, **kwargs):
+                target = self._values
+                for key in path[:-1]:
+                        target = target.setdefault(key, {})
+                target[path[-1]] = value
+
+        def get_plugin_logfile_path(self, postfix=None):
+                return os.path.join(tempfile.gettempdir(), f"plugin_domoticz_{postfix}.log")
+
+
+class PluginManager(object):
+        def __init__(self):
+                self.messages = []
+
+        def send_plugin_message(self, identifier, data):
+                self.messages.append(data)
+
+        def get_helpers(self, name, *methods):
+                return None
+
+
+class Printer(object):
+        def is_closed_or_error(self):
+                return False
+
+        def is_printing(self):
+                return False
+
+        def connect(self, *args, **kwargs):
+                pass
+
+        def disconnect(self, *args, **kwargs):
+                pass
+
+
+def make_plug(ip, idx, **overrides):
+        plug = dict(octoprint_domoticz.domoticzPlugin().get_settings_defaults()["arrSmartplugs"][0])
+        plug.update({
+                "ip": ip,
+                "idx": str(idx),
+                "label": f"plug {idx}",
+                "displayWarning": False,
+                "autoConnect": False,
+                "autoDisconnect": False,
+        })
+        plug.update(overrides)
+        return plug
+
+
+def make_plugin(plugs, **settings):
+        plugin = octoprint_domoticz.domoticzPlugin()
+        values = plugin.get_settings_defaults()
+        values.update({"pollInterval": 0})
+        values.update(settings)
+        values["arrSmartplugs"] = plugs
+        plugin._settings = Settings(values)
+        plugin._plugin_manager = PluginManager()
+        plugin._printer = Printer()
+        plugin._identifier = "domoticz"
+        plugin.on_startup("127.0.0.1", 5000)
+        plugin.on_after_startup()
+        return plugin
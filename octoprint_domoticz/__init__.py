@@ -1,17 +1,39 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import contextvars
+import itertools
+import json
 import logging
-import os
+import random
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import octoprint.plugin
 import octoprint.util
-import requests
 from octoprint.access.permissions import Permissions, ADMIN_GROUP, USER_GROUP
 from flask_babel import gettext
 
+from .client import CircuitOpenError, DomoticzClient, DomoticzRequestError
+from .coalesce import LatestIntent, SingleFlight
+from .commands import SystemCommandRunner
+from .limiter import PRIORITY_COMMAND, PRIORITY_CRITICAL, PRIORITY_POLL, request_priority, reset_priority, set_priority
+from .logs import LOG_FILTER, DeferredHandler, new_correlation_id, reset_correlation_id
+from .metrics import DomoticzMetrics
+from .registry import PlugRegistry
+from .scheduler import ActionScheduler
+from .state import StateCache, plug_key
+from .telemetry import Telemetry, parse_reading
+
+GCODE_PREFIXES = ("M80", "M81", "@DOMOTICZ")
+
+# seconds between checks whether a powered on printer is ready for a connection
+AUTO_CONNECT_PROBE_INTERVAL = 0.5
+
+# plug states published within this many seconds reach the browsers in one message
+STATE_BATCH_WINDOW = 0.05
+
 
 class domoticzPlugin(
         octoprint.plugin.SettingsPlugin,
@@ -19,24 +41,65 @@ class domoticzPlugin(
         octoprint.plugin.TemplatePlugin,
         octoprint.plugin.SimpleApiPlugin,
         octoprint.plugin.StartupPlugin,
+        octoprint.plugin.ShutdownPlugin,
+        octoprint.plugin.BlueprintPlugin,
+        octoprint.plugin.EventHandlerPlugin,
 ):
         def __init__(self):
                 self._logger = logging.getLogger("octoprint.plugins.domoticz")
                 self._domoticz_logger = logging.getLogger("octoprint.plugins.domoticz.debug")
+                self._metrics = DomoticzMetrics()
+                self._client = DomoticzClient(metrics=self._metrics)
+                self._state_cache = StateCache()
+                self._registry = PlugRegistry(lambda: self._settings.get(["arrSmartplugs"]))
+                self._flights = SingleFlight(logger=self._domoticz_logger)
+                self._intents = LatestIntent()
+                self._telemetry = Telemetry()
+                self._poll_timer = None
+                # status checks and sweeps get workers of their own, switch commands never queue behind them
+                self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="domoticz")
+                self._command_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="domoticz.command")
+                self._group_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="domoticz.group")
+                self._job_ids = itertools.count(1)
+                self._scheduler = ActionScheduler(self._submit, logger=self._domoticz_logger)
+                self._command_runner = None
+                self._engine = None
+                self._engine_lock = threading.Lock()
+                self._aiohttp = None
+                self._metrics.add_gauge(
+                        "domoticz_scheduled_actions", "Delayed actions waiting in the scheduler.", self._scheduler.size
+                )
+                self._metrics.add_gauge(
+                        "domoticz_executor_queue", "Actions waiting for a free worker.", lambda: self._executor._work_queue.qsize()
+                )
+                self._metrics.add_gauge(
+                        "domoticz_command_queue",
+                        "Switch commands waiting for a free worker.",
+                        lambda: self._command_executor._work_queue.qsize(),
+                )
+                self._metrics.add_gauge(
+                        "domoticz_rate_limit_queued", "Requests waiting for the rate limit of their server.", self._client.limiter.queued
+                )
+                self._mqtt_topic = None
+                self._push_plugs = {}
+                self._gcode_plugs = {}
+                self._gcode_plugs_by_idx = {}
+                self._gcode_groups = {}
+                self._gcode_enabled = False
+                self._idle_cooling = {}
+                self._idle_lock = threading.Lock()
+                self._auto_connects = {}
+                self._state_batch = {}
+                self._state_batch_due = False
+                self._state_batch_lock = threading.Lock()
 
         ##~~ StartupPlugin mixin
 
         def on_startup(self, host, port):
-                # setup customized logger
-                from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
-
-                domoticz_logging_handler = CleaningTimedRotatingFileHandler(
-                        self._settings.get_plugin_logfile_path(postfix="debug"),
-                        when="D",
-                        backupCount=3,
-                )
+                # setup customized logger, the log file is opened with the first record written to it
+                domoticz_logging_handler = DeferredHandler(self._debug_log_handler)
                 domoticz_logging_handler.setFormatter(
-                        logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s")
+                        logging.Formatter("[%(asctime)s] %(levelname)s: %(correlation)s%(message)s")
                 )
                 domoticz_logging_handler.setLevel(logging.DEBUG)
 
@@ -47,18 +110,72 @@ class domoticzPlugin(
                         else logging.INFO
                 )
                 self._domoticz_logger.propagate = False
+                # logger level filters only see records that passed the level check
+                self._domoticz_logger.addFilter(LOG_FILTER)
+                self._logger.addFilter(LOG_FILTER)
+
+                self._rebuild_gcode_index()
+                self._configure_client()
+                self._configure_telemetry()
+                self._start_command_runner()
+
+        def _debug_log_handler(self):
+                from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
+
+                return CleaningTimedRotatingFileHandler(
+                        self._settings.get_plugin_logfile_path(postfix="debug"),
+                        when="D",
+                        backupCount=3,
+                )
 
         def on_after_startup(self):
                 self._logger.info("Domoticz loaded!")
+                self._start_push_subscriber()
+                self._start_poller()
+
+        ##~~ ShutdownPlugin mixin
+
+        def on_shutdown(self):
+                if self._poll_timer is not None:
+                        self._poll_timer.cancel()
+                self._scheduler.stop()
+                self._executor.shutdown(wait=False)
+                self._command_executor.shutdown(wait=False)
+                self._group_executor.shutdown(wait=False)
+                if self._command_runner is not None:
+                        self._command_runner.shutdown()
+                self._stop_async_engine()
 
         ##~~ SettingsPlugin mixin
 
         def get_settings_defaults(self):
                 return {
                         "debug_logging": False,
+                        "pollInterval": 60,
+                        "pollJitter": 5,
+                        "stateTTL": 90,
+                        "requestTimeoutMin": 2,
+                        "requestTimeoutMax": 10,
+                        "circuitFailureThreshold": 3,
+                        "circuitResetTimeout": 30,
+                        "requestRate": 10,
+                        "requestBurst": 20,
+                        "asyncRequests": True,
+                        "asyncLimitPerHost": 4,
+                        "sysCmdTimeout": 60,
+                        "sysCmdMaxConcurrent": 2,
+                        "mqttEnabled": False,
+                        "mqttTopic": "domoticz/out",
+                        "mqttServer": "",
+                        "pushPollInterval": 600,
+                        "telemetryEnabled": False,
+                        "telemetrySamples": 1440,
+                        "telemetryJobs": 20,
+                        "idleTemperature": 50,
                         "arrSmartplugs": [
                                 {
                                         "ip": "",
+                                        "type": "device",
                                         "displayWarning": True,
                                         "ignoreSSL": False,
                                         "idx": "1",
@@ -76,7 +193,8 @@ class domoticzPlugin(
                                         "sysCmdOff": False,
                                         "sysRunCmdOff": "",
                                         "sysCmdOffDelay": 0,
-                                        "currentState": "unknown",
+                                        "idleOff": False,
+                                        "idleTimeout": 30,
                                         "btnColor": "#808080",
                                         "username": "",
                                         "password": "",
@@ -85,12 +203,33 @@ class domoticzPlugin(
                                         "label": "",
                                 }
                         ],
+                        "arrGroups": [],
                 }
 
         def on_settings_save(self, data):
                 old_debug_logging = self._settings.get_boolean(["debug_logging"])
 
+                # plug state lives in the state cache, never write it to config.yaml
+                for plug in data.get("arrSmartplugs") or []:
+                        plug.pop("currentState", None)
+                # a cleared stage input arrives as an empty string
+                for group in data.get("arrGroups") or []:
+                        for member in group.get("members") or []:
+                                member["stage"] = self.group_stage(member)
+
                 octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+                self._registry.invalidate()
+                self._rebuild_gcode_index()
+                self._client.reset()
+                self._configure_client()
+                self._configure_telemetry()
+                self._state_cache.clear()
+                self._start_push_subscriber()
+                # restarted with the new settings by the next sweep
+                self._stop_async_engine()
+                self._aiohttp = None
+                self._start_poller()
+                self._start_command_runner()
 
                 new_debug_logging = self._settings.get_boolean(["debug_logging"])
                 if old_debug_logging != new_debug_logging:
@@ -100,7 +239,7 @@ class domoticzPlugin(
                                 self._domoticz_logger.setLevel(logging.INFO)
 
         def get_settings_version(self):
-                return 5
+                return 8
 
         def on_settings_migrate(self, target, current=None):
                 if current is None or current < 3:
@@ -116,7 +255,7 @@ class domoticzPlugin(
                                 plug["passcode"] = ""
                                 arr_smart_plugs_new.append(plug)
                         self._settings.set(["arrSmartplugs"], arr_smart_plugs_new)
-                if current < 5 and current > 2:
+                if current is not None and 2 < current < 5:
                         # add new properties to configured switches
                         arr_smart_plugs_new = []
                         for plug in self._settings.get(['arrSmartplugs']):
@@ -124,6 +263,29 @@ class domoticzPlugin(
                                 plug["ignoreSSL"] = False
                                 arr_smart_plugs_new.append(plug)
                         self._settings.set(["arrSmartplugs"], arr_smart_plugs_new)
+                if current is not None and 2 < current < 6:
+                        # runtime state is no longer persisted
+                        arr_smart_plugs_new = []
+                        for plug in self._settings.get(['arrSmartplugs']):
+                                plug.pop("currentState", None)
+                                arr_smart_plugs_new.append(plug)
+                        self._settings.set(["arrSmartplugs"], arr_smart_plugs_new)
+                if current is not None and 2 < current < 7:
+                        # plugs configured so far are all single devices
+                        arr_smart_plugs_new = []
+                        for plug in self._settings.get(['arrSmartplugs']):
+                                plug.setdefault("type", "device")
+                                arr_smart_plugs_new.append(plug)
+                        self._settings.set(["arrSmartplugs"], arr_smart_plugs_new)
+                if current is not None and 2 < current < 8:
+                        # add new properties to configured switches
+                        arr_smart_plugs_new = []
+                        for plug in self._settings.get(['arrSmartplugs']):
+                                plug.setdefault("idleOff", False)
+                                plug.setdefault("idleTimeout", 30)
+                                arr_smart_plugs_new.append(plug)
+                        self._settings.set(["arrSmartplugs"], arr_smart_plugs_new)
+                self._registry.invalidate()
 
         ##~~ AssetPlugin mixin
 
@@ -143,303 +305,970 @@ class domoticzPlugin(
         def turn_on(self, plug_ip, plug_idx, ignoreSSL, username="", password="", passcode=""):
                 if self._settings.get(["singleRelay"]):
                         plug_idx = ""
-                self._domoticz_logger.debug(f"Turning on {plug_ip} index {plug_idx}.")
-                plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plug_ip, "idx", plug_idx)
-                try:
-                        str_url = f"{plug_ip}/json.htm?type=command&param=switchlight&idx={plug_idx}&switchcmd=On"
-                        if passcode != "":
-                                str_url = f"{str_url}&passcode={passcode}"
-                        if ignoreSSL:
-                            if username and password:
-                                web_response = requests.get(str_url, auth=(username, password), timeout=10, verify=False)
-                            else:
-                                web_response = requests.get(str_url, timeout=10, verify=False)
-                        else:
-                            if username and password:
-                                web_response = requests.get(str_url, auth=(username, password), timeout=10)
-                            else:
-                                web_response = requests.get(str_url, timeout=10)
-                        response = web_response.json()
-                        chk = response["status"]
-                except Exception:
-                        self._domoticz_logger.error(f"Invalid ip or unknown error connecting to {plug_ip}.", exc_info=True)
-                        response = f"Unknown error turning on {plug_ip} index {plug_idx}."
-                        chk = "UNKNOWN"
-
-                self._domoticz_logger.debug(f"Response: {response}")
+                self._domoticz_logger.debug("Turning on %s index %s.", plug_ip, plug_idx)
+                self._cancel_pending(plug_ip, plug_idx, "power", "sysCmdOff")
+                plug = self._registry.plug(plug_ip, plug_idx)
+                auto_connect = plug["autoConnect"] and self._printer.is_closed_or_error()
+                # ports that exist before power on can't tell whether the printer booted
+                ports_before = self._serial_ports() if auto_connect else None
+                chk = self._switch(plug, plug_ip, plug_idx, "On", ignoreSSL, username, password, passcode)
+                if chk is None:
+                        return
                 if chk == "OK":
-                        if plug["autoConnect"] and self._printer.is_closed_or_error():
-                                c = threading.Timer(int(plug["autoConnectDelay"]), self._printer.connect)
-                                c.start()
+                        if auto_connect:
+                                # a probe already running can't be cancelled through the scheduler, it checks its token instead
+                                token = self._auto_connects[plug_key(plug_ip, plug_idx)] = object()
+                                deadline = time.monotonic() + float(plug["autoConnectDelay"])
+                                self._schedule(
+                                        0, self._await_printer, [plug, token, ports_before, deadline],
+                                        key=plug_key(plug_ip, plug_idx) + ("connect",),
+                                )
                         if plug["sysCmdOn"]:
-                                t = threading.Timer(
-                                        int(plug["sysCmdOnDelay"]), os.system, args=[plug["sysRunCmdOn"]]
+                                self._schedule(
+                                        float(plug["sysCmdOnDelay"]), self._run_system_command, [plug["sysRunCmdOn"], plug, "sysCmdOn"],
+                                        key=plug_key(plug_ip, plug_idx) + ("sysCmdOn",),
                                 )
-                                t.start()
-                        self._plugin_manager.send_plugin_message(
-                                self._identifier, {"currentState": "on", "ip": plug_ip, "idx": plug_idx}
-                        )
+                        if plug.get("idleOff") and not self._printer.is_printing():
+                                self._start_idle_timer(plug, "powered on")
+                        self._publish_state(plug_ip, plug_idx, "on")
+                        return "on"
                 else:
-                        self._domoticz_logger.debug(response)
-                        self._plugin_manager.send_plugin_message(
-                                self._identifier,
-                                {"currentState": "unknown", "ip": plug_ip, "idx": plug_idx},
-                        )
+                        self._publish_state(plug_ip, plug_idx, "unknown")
+                        return "unknown"
 
         def turn_off(self, plug_ip, plug_idx, ignoreSSL, username="", password="", passcode=""):
-                self._domoticz_logger.debug(f"Turning off {plug_ip} index {plug_idx}.")
-                plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plug_ip, "idx", plug_idx)
+                delay = self._prepare_off(plug_ip, plug_idx)
+
+                # give the printer time to disconnect without holding on to the calling thread
+                self._schedule(
+                        delay,
+                        self._switch_off,
+                        [plug_ip, plug_idx, ignoreSSL],
+                        {"username": username, "password": password, "passcode": passcode},
+                        key=plug_key(plug_ip, plug_idx) + ("power",),
+                )
+
+        def _prepare_off(self, plug_ip, plug_idx):
+                # runs the side effects of powering off and returns how long to wait before switching
+                self._domoticz_logger.debug("Turning off %s index %s.", plug_ip, plug_idx)
+                self._cancel_pending(plug_ip, plug_idx, "power", "connect", "sysCmdOn", "idle")
+                self._auto_connects.pop(plug_key(plug_ip, plug_idx), None)
+                with self._idle_lock:
+                        self._idle_cooling.pop(plug_key(plug_ip, plug_idx), None)
+                plug = self._registry.plug(plug_ip, plug_idx)
+                delay = 0
                 try:
                         if plug["sysCmdOff"]:
-                                self._domoticz_logger.debug(f'Running system command: {plug["sysRunCmdOff"]} in {plug["sysCmdOffDelay"]}')
-                                t = threading.Timer(int(plug["sysCmdOffDelay"]), os.system, args=[plug["sysRunCmdOff"]])
-                                t.start()
+                                self._domoticz_logger.debug("Running system command: %s in %s", plug["sysRunCmdOff"], plug["sysCmdOffDelay"])
+                                self._schedule(
+                                        float(plug["sysCmdOffDelay"]), self._run_system_command, [plug["sysRunCmdOff"], plug, "sysCmdOff"],
+                                        key=plug_key(plug_ip, plug_idx) + ("sysCmdOff",),
+                                )
 
                         if plug["autoDisconnect"]:
                                 self._domoticz_logger.debug("Disconnecting from printer")
                                 self._printer.disconnect()
-                                time.sleep(int(plug["autoDisconnectDelay"]))
-                        str_url = f"{plug_ip}/json.htm?type=command&param=switchlight&idx={plug_idx}&switchcmd=Off"
-                        if passcode != "":
-                                str_url = f"{str_url}&passcode={passcode}"
-                        if ignoreSSL:
-                            if username and password:
-                                web_response = requests.get(str_url, auth=(username, password), timeout=10, verify=False)
-                            else:
-                                web_response = requests.get(str_url, timeout=10, verify=False)
-                        else:
-                            if username and password:
-                                web_response = requests.get(str_url, auth=(username, password), timeout=10)
-                            else:
-                                web_response = requests.get(str_url, timeout=10)
-                        response = web_response.json()
-                        chk = response["status"]
+                                delay = float(plug["autoDisconnectDelay"])
                 except Exception:
-                        self._domoticz_logger.error(f"Invalid ip or unknown error connecting to {plug_ip}.", exc_info=True)
-                        response = f"Unknown error turning off {plug_ip} index {plug_idx}."
-                        chk = "UNKNOWN"
+                        self._domoticz_logger.error("Error preparing power off of %s index %s.", plug_ip, plug_idx, exc_info=True)
+                return delay
 
-                self._domoticz_logger.debug("Response: %s" % response)
+        def _switch_off(self, plug_ip, plug_idx, ignoreSSL, username="", password="", passcode=""):
+                plug = self._registry.plug(plug_ip, plug_idx)
+                chk = self._switch(plug, plug_ip, plug_idx, "Off", ignoreSSL, username, password, passcode)
+                if chk is None:
+                        return
                 if chk == "OK":
-                        self._plugin_manager.send_plugin_message(
-                                self._identifier, {"currentState": "off", "ip": plug_ip, "idx": plug_idx}
-                        )
+                        self._publish_state(plug_ip, plug_idx, "off")
+                        return "off"
                 else:
-                        self._domoticz_logger.debug(response)
-                        self._plugin_manager.send_plugin_message(
-                                self._identifier,
-                                {"currentState": "unknown", "ip": plug_ip, "idx": plug_idx},
+                        self._publish_state(plug_ip, plug_idx, "unknown")
+                        return "unknown"
+
+        def _switch(self, plug, plug_ip, plug_idx, switchcmd, ignoreSSL, username, password, passcode):
+                # one command per device at a time, returns None if a later command for the device replaced this one
+                chk = self._intents.run(
+                        plug_key(plug_ip, plug_idx), switchcmd, self._send_switch,
+                        plug, plug_ip, plug_idx, switchcmd, ignoreSSL, username, password, passcode,
+                )
+                if chk is LatestIntent.SUPERSEDED:
+                        self._domoticz_logger.debug("Dropped %s of %s index %s, superseded by a later command.", switchcmd, plug_ip, plug_idx)
+                        self._metrics.coalesced.inc("switch_superseded")
+                        return None
+                return chk
+
+        def _send_switch(self, plug, plug_ip, plug_idx, switchcmd, ignoreSSL, username, password, passcode):
+                try:
+                        entry = self._registry.get(plug_ip, plug_idx)
+                        str_query = entry.switch_query(switchcmd, passcode) if entry is not None else None
+                        if str_query is None:
+                                str_query = f"type=command&param={self.switch_param(plug)}&idx={plug_idx}&switchcmd={switchcmd}"
+                                if passcode != "":
+                                        str_query = f"{str_query}&passcode={passcode}"
+                        web_response, response = self._client.get_json(
+                                plug_ip, str_query, username, password, verify=not ignoreSSL
+                        )
+                        chk = response["status"]
+                except DomoticzRequestError as e:
+                        self._log_request_error(f"Could not turn {switchcmd.lower()} {plug_ip} index {plug_idx}", e)
+                        response = f"Unknown error turning {switchcmd.lower()} {plug_ip} index {plug_idx}."
+                        chk = "UNKNOWN"
+                except Exception:
+                        self._domoticz_logger.error("Invalid ip or unknown error connecting to %s.", plug_ip, exc_info=True)
+                        response = f"Unknown error turning {switchcmd.lower()} {plug_ip} index {plug_idx}."
+                        chk = "UNKNOWN"
+
+                self._domoticz_logger.debug("Response: %s", response)
+                return chk
+
+        def _await_printer(self, plug, token, ports_before, deadline, confirmed=False, started=None):
+                # connects as soon as Domoticz confirms the plug is on and the printer's port is usable,
+                # autoConnectDelay is only the upper bound for printers whose readiness can't be seen
+                key = plug_key(plug["ip"], plug["idx"])
+                now = time.monotonic()
+                started = now if started is None else started
+                if self._auto_connects.get(key) is not token:
+                        return
+                if not self._printer.is_closed_or_error():
+                        self._auto_connects.pop(key, None)
+                        return
+                if not confirmed:
+                        confirmed = self._query_state(plug["ip"], plug["idx"], plug["ignoreSSL"], plug["username"], plug["password"]) == "on"
+                ready = confirmed and self._port_ready(ports_before)
+                if ready or now >= deadline:
+                        self._domoticz_logger.debug(
+                                "Connecting printer %.1fs after powering on %s index %s (%s).",
+                                now - started, plug["ip"], plug["idx"], "ready" if ready else "delay expired",
                         )
+                        self._auto_connects.pop(key, None)
+                        self._printer.connect()
+                        return
+                self._scheduler.schedule(
+                        min(AUTO_CONNECT_PROBE_INTERVAL, deadline - now), self._await_printer,
+                        [plug, token, ports_before, deadline, confirmed, started],
+                        key=key + ("connect",),
+                        label=f"auto connect {plug['label'] or plug['idx']}",
+                )
+
+        def _serial_ports(self):
+                try:
+                        return set(self._printer.get_connection_options().get("ports") or [])
+                except Exception:
+                        self._domoticz_logger.debug("Could not list serial ports.", exc_info=True)
+                        return set()
+
+        def _port_ready(self, ports_before):
+                try:
+                        options = self._printer.get_connection_options()
+                except Exception:
+                        # not ready yet, the probe goes on and connects once the delay expired
+                        self._domoticz_logger.debug("Could not list serial ports.", exc_info=True)
+                        return False
+                ports = set(options.get("ports") or [])
+                preferred = options.get("portPreference")
+                if preferred and preferred != "AUTO":
+                        return preferred in ports and preferred not in ports_before
+                return bool(ports - ports_before)
 
         def gcode_turn_off(self, plug):
                 if plug["warnPrinting"] and self._printer.is_printing():
-                        self._domoticz_logger.debug(f"Not powering off {plug['label']} since new print has started.")
+                        self._domoticz_logger.debug("Not powering off %s since new print has started.", plug['label'])
                 else:
                         self.turn_off(plug["ip"], plug["idx"], plug["ignoreSSL"], username=plug["username"], password=plug["password"],
                                                   passcode=plug["passcode"])
 
         def check_status(self, plug_ip, plug_idx, ignoreSSL, username="", password=""):
-                self._domoticz_logger.debug(f"Checking status of {plug_ip} index {plug_idx}.")
-                if plug_ip != "":
-                        try:
-                            str_url = f"{plug_ip}/json.htm?type=command&param=getdevices&rid={plug_idx}"
-                            if ignoreSSL:
-                                if username != "":
-                                    web_response = requests.get(str_url, auth=(username, password), timeout=10, verify=False)
-                                else:
-                                    web_response = requests.get(str_url, timeout=10, verify=False)
-                            else:
-                                if username != "":
-                                    web_response = requests.get(str_url, auth=(username, password), timeout=10)
-                                else:
-                                    web_response = requests.get(str_url, timeout=10)
-
-                            self._domoticz_logger.debug(f"{plug_ip} index {plug_idx} response: {web_response}")
-                            response = web_response.json()
-                            chk = response["result"][0]["Status"]
-                        except Exception:
-                            self._domoticz_logger.error(f"Invalid ip or unknown error connecting to {plug_ip}.", exc_info=True)
-                            response = f"unknown error with {plug_ip}."
-                            chk = "UNKNOWN"
-
-                        self._domoticz_logger.debug(f"{plug_ip} index {plug_idx} is {chk}")
-                        if chk == "On":
-                            self._plugin_manager.send_plugin_message(
-                                self._identifier, {"currentState": "on", "ip": plug_ip, "idx": plug_idx}
-                            )
-                        elif chk == "Off":
-                            self._plugin_manager.send_plugin_message(
-                                self._identifier,
-                                {"currentState": "off", "ip": plug_ip, "idx": plug_idx},
-                            )
+                self._domoticz_logger.debug("Checking status of %s index %s.", plug_ip, plug_idx)
+                cached = self._state_cache.get(plug_ip, plug_idx, max_age=self._state_max_age(plug_ip, plug_idx))
+                if cached not in (None, "unknown"):
+                        self._domoticz_logger.debug("%s index %s is %s (cached)", plug_ip, plug_idx, cached)
+                        self._queue_state(plug_ip, plug_idx, cached)
+                elif plug_ip != "":
+                        key, query, is_scene = self._status_query(plug_ip, plug_idx, ignoreSSL, username, password)
+                        # a check of the same plug in flight publishes for this one too, no worker waits for it
+                        shared = self._flights.do_or_join(
+                                key,
+                                lambda result, error: self._publish_state(
+                                        plug_ip, plug_idx, self._state_from_result(plug_ip, plug_idx, is_scene, result, error)
+                                ),
+                                self._client.get_json,
+                                plug_ip,
+                                query,
+                                username,
+                                password,
+                                verify=not ignoreSSL,
+                        )
+                        if shared:
+                                self._metrics.coalesced.inc("status")
+
+        def _query_state(self, plug_ip, plug_idx, ignoreSSL, username="", password=""):
+                key, query, is_scene = self._status_query(plug_ip, plug_idx, ignoreSSL, username, password)
+                try:
+                        # checks from several browsers at once share one request
+                        result, shared = self._flights.do(
+                                key, self._client.get_json, plug_ip, query, username, password, verify=not ignoreSSL
+                        )
+                except Exception as e:
+                        return self._state_from_result(plug_ip, plug_idx, is_scene, None, e)
+                if shared:
+                        self._metrics.coalesced.inc("status")
+                return self._state_from_result(plug_ip, plug_idx, is_scene, result, None)
+
+        def _status_query(self, plug_ip, plug_idx, ignoreSSL, username, password):
+                entry = self._registry.get(plug_ip, plug_idx)
+                if entry is not None:
+                        is_scene = entry.plug.get("type") == "scene"
+                        query = entry.status_query
+                else:
+                        # not configured (yet), checked as a device
+                        is_scene = False
+                        query = f"type=command&param=getdevices&rid={plug_idx}"
+                return (plug_ip.rstrip("/").lower(), query, username, password, ignoreSSL), query, is_scene
+
+        def _state_from_result(self, plug_ip, plug_idx, is_scene, result, error):
+                try:
+                        if error is not None:
+                                raise error
+                        web_response, response = result
+                        self._domoticz_logger.debug("%s index %s response: %s", plug_ip, plug_idx, web_response)
+                        if is_scene:
+                                chk = self.scene_statuses(response).get(str(plug_idx))
+                        else:
+                                chk = response["result"][0]["Status"]
+                except DomoticzRequestError as e:
+                        self._log_request_error(f"Could not check status of {plug_ip} index {plug_idx}", e)
+                        response = f"unknown error with {plug_ip}."
+                        chk = "UNKNOWN"
+                except Exception:
+                        self._domoticz_logger.error("Invalid ip or unknown error connecting to %s.", plug_ip, exc_info=True)
+                        response = f"unknown error with {plug_ip}."
+                        chk = "UNKNOWN"
+
+                self._domoticz_logger.debug("%s index %s is %s", plug_ip, plug_idx, chk)
+                state = self.state_from_status(chk)
+                if state == "unknown":
+                        self._domoticz_logger.debug("Response: %s", response)
+                return state
+
+        def check_all_statuses(self):
+                states = self._cached_states()
+                if states is not None:
+                        self._plugin_manager.send_plugin_message(self._identifier, {"states": states})
+                # a browser asking during a sweep gets its result without holding a worker until it is done
+                elif self._flights.do_or_join("sweep", self._send_sweep, self._sweep_all_statuses):
+                        self._metrics.coalesced.inc("sweep")
+
+        def _send_sweep(self, result, error):
+                if error is not None:
+                        self._domoticz_logger.error("Could not check the status of the plugs.", exc_info=(type(error), error, error.__traceback__))
+                        return
+                states, _ = result
+                self._plugin_manager.send_plugin_message(self._identifier, {"states": states})
+
+        def _cached_states(self):
+                # only answer from the cache if every configured plug has a fresh entry
+                states = []
+                for plug in self._registry.plugs():
+                        if plug["ip"] == "":
+                                continue
+                        state = self._state_cache.get(plug["ip"], plug["idx"], max_age=self._state_max_age(plug["ip"], plug["idx"]))
+                        if state in (None, "unknown"):
+                                return None
+                        states.append({"currentState": state, "ip": plug["ip"], "idx": plug["idx"]})
+                return states
+
+        def _state_max_age(self, plug_ip, plug_idx):
+                ttl = self._settings.get_int(["stateTTL"])
+                if ttl <= 0 or self._mqtt_topic is None:
+                        return ttl
+                key = plug_key(plug_ip, plug_idx)
+                if not any(plug_key(plug["ip"], plug["idx"]) == key for plug in self._push_plugs.get(str(plug_idx), ())):
+                        # scenes and plugs of other servers aren't pushed
+                        return ttl
+                # Domoticz only publishes changes, the state of an unchanged plug is confirmed by the fallback poll
+                return max(ttl, self._settings.get_int(["pushPollInterval"]) + self._settings.get_int(["pollJitter"]))
+
+        def _sweep_statuses(self):
+                # the poller and any number of browsers asking at the same time share one sweep
+                result, shared = self._flights.do("sweep", self._sweep_all_statuses)
+                if shared:
+                        self._metrics.coalesced.inc("sweep")
+                return result
+
+        def _sweep_all_statuses(self):
+                # one getdevices query per server, then fan the device list out to the configured plugs
+                servers = {}
+                for plug in self._registry.plugs():
+                        if plug["ip"] == "":
+                                continue
+                        key = (plug["ip"].rstrip("/").lower(), plug["username"], plug["password"], plug["ignoreSSL"])
+                        servers.setdefault(key, []).append(plug)
+
+                # the queries of all servers go out as one batch, concurrently when the async engine runs
+                queries = []
+                for key, plugs in servers.items():
+                        self._domoticz_logger.debug("Checking status of %s plugs on %s.", len(plugs), plugs[0]['ip'])
+                        params = set(self.switch_param(plug) for plug in plugs)
+                        if "switchlight" in params:
+                                queries.append((key, "switchlight", "type=command&param=getdevices&filter=all"))
+                        if "switchscene" in params:
+                                queries.append((key, "switchscene", "type=command&param=getscenes"))
+                if len(queries) > 1:
+                        self._start_async_engine()
+                results = self._client.get_json_many([
+                        (servers[key][0]["ip"], query, key[1], key[2], not key[3]) for key, _, query in queries
+                ])
+
+                statuses = {}
+                for (key, param, _), result in zip(queries, results):
+                        response = self._query_result(servers[key][0], result)
+                        if response is None:
+                                continue
+                        if param == "switchlight":
+                                devices = {str(device["idx"]): device for device in response.get("result", [])}
                         else:
-                            self._domoticz_logger.debug(response)
-                            self._plugin_manager.send_plugin_message(
-                                self._identifier,
-                                {"currentState": "unknown", "ip": plug_ip, "idx": plug_idx},
-                            )
+                                devices = {idx: {"Status": status} for idx, status in self.scene_statuses(response).items()}
+                        statuses[key, param] = devices
+
+                states = []
+                changed = False
+                telemetry = self._settings.get_boolean(["telemetryEnabled"])
+                debug = self._domoticz_logger.isEnabledFor(logging.DEBUG)
+                now = time.time()
+                for key, plugs in servers.items():
+                        for plug in plugs:
+                                device = statuses.get((key, self.switch_param(plug)), {}).get(plug["idx"], {})
+                                if telemetry:
+                                        power, energy = parse_reading(device)
+                                        if power is not None or energy is not None:
+                                                self._telemetry.record(plug, now, power, energy)
+                                state = self.state_from_status(device.get("Status"))
+                                if debug:
+                                        self._domoticz_logger.debug("%s index %s is %s", plug['ip'], plug['idx'], state)
+                                states.append({"currentState": state, "ip": plug["ip"], "idx": plug["idx"]})
+                                changed = self._state_cache.update(plug["ip"], plug["idx"], state) or changed
+
+                return states, changed
+
+        def _query_result(self, server, result):
+                if not isinstance(result, Exception):
+                        return result[1]
+                if isinstance(result, DomoticzRequestError):
+                        self._log_request_error(f"Could not check status of plugs on {server['ip']}", result)
+                else:
+                        self._domoticz_logger.error(
+                                "Invalid ip or unknown error connecting to %s.", server['ip'], exc_info=result
+                        )
+                return None
+
+        def _publish_state(self, plug_ip, plug_idx, state):
+                self._state_cache.update(plug_ip, plug_idx, state)
+                self._queue_state(plug_ip, plug_idx, state)
+
+        def _queue_state(self, plug_ip, plug_idx, state):
+                # members of a group or a burst of pushed changes go out as one states message,
+                # a newer state of the same plug replaces the queued one
+                with self._state_batch_lock:
+                        self._state_batch[plug_key(plug_ip, plug_idx)] = {"currentState": state, "ip": plug_ip, "idx": plug_idx}
+                        if self._state_batch_due:
+                                return
+                        self._state_batch_due = True
+                self._scheduler.schedule(STATE_BATCH_WINDOW, self._flush_states, label="publish states")
+
+        def _flush_states(self):
+                with self._state_batch_lock:
+                        states = list(self._state_batch.values())
+                        self._state_batch = {}
+                        self._state_batch_due = False
+                if states:
+                        self._plugin_manager.send_plugin_message(self._identifier, {"states": states})
+
+        def _log_request_error(self, message, error):
+                # requests to a server with an open circuit fail by design, the failures that opened it were logged already
+                if isinstance(error, CircuitOpenError):
+                        self._domoticz_logger.debug("%s: %s", message, error)
+                else:
+                        self._domoticz_logger.error("%s: %s", message, error)
+
+        def _configure_client(self):
+                self._client.configure(
+                        failure_threshold=self._settings.get_int(["circuitFailureThreshold"]),
+                        reset_timeout=self._settings.get_int(["circuitResetTimeout"]),
+                        min_timeout=self._settings.get_float(["requestTimeoutMin"]),
+                        max_timeout=self._settings.get_float(["requestTimeoutMax"]),
+                )
+                self._client.limiter.configure(
+                        rate=max(0.0, self._settings.get_float(["requestRate"])),
+                        burst=max(1, self._settings.get_int(["requestBurst"])),
+                )
+
+        def _start_async_engine(self):
+                # started by the first sweep with more than one query, instances without plugs never load asyncio or aiohttp
+                if self._engine is not None or self._aiohttp is False or not self._settings.get_boolean(["asyncRequests"]):
+                        return
+                from . import aio
+
+                with self._engine_lock:
+                        if self._engine is not None:
+                                return
+                        self._aiohttp = aio.available()
+                        if not self._aiohttp:
+                                self._domoticz_logger.info("aiohttp is not installed, status sweeps query one server after the other.")
+                                return
+                        engine = aio.AsyncEngine(self._client, limit_per_host=max(1, self._settings.get_int(["asyncLimitPerHost"])))
+                        engine.start()
+                        self._client.set_engine(engine)
+                        self._engine = engine
+
+        def _stop_async_engine(self):
+                with self._engine_lock:
+                        engine, self._engine = self._engine, None
+                if engine is not None:
+                        self._client.set_engine(None)
+                        engine.stop()
+
+        def _configure_telemetry(self):
+                self._telemetry.configure(
+                        capacity=max(1, self._settings.get_int(["telemetrySamples"])),
+                        max_jobs=max(1, self._settings.get_int(["telemetryJobs"])),
+                )
+
+        ##~~ Status poller
+
+        def _start_poller(self):
+                if self._poll_timer is not None:
+                        self._poll_timer.cancel()
+                        self._poll_timer = None
+
+                if self._settings.get_int(["pollInterval"]) <= 0:
+                        self._domoticz_logger.debug("Background status polling disabled.")
+                        return
+
+                self._poll_timer = octoprint.util.RepeatedTimer(
+                        self._poll_interval, self._poll_statuses, run_first=True, daemon=True
+                )
+                self._poll_timer.start()
+
+        def _poll_interval(self):
+                # with push updates flowing the poll is only a fallback for missed messages
+                interval = self._settings.get_int(["pushPollInterval" if self._mqtt_topic else "pollInterval"])
+                # spread the polls of several OctoPrint instances hitting the same Domoticz server
+                return max(1, interval + random.uniform(0, self._settings.get_int(["pollJitter"])))
+
+        def _poll_statuses(self):
+                correlation = new_correlation_id("poll")
+                priority = set_priority(PRIORITY_POLL)
+                try:
+                        states, changed = self._sweep_statuses()
+                except Exception:
+                        self._domoticz_logger.error("Error polling plug statuses.", exc_info=True)
+                        return
+                else:
+                        if changed:
+                                self._plugin_manager.send_plugin_message(self._identifier, {"states": states})
+                        if self._settings.get_boolean(["telemetryEnabled"]):
+                                self._plugin_manager.send_plugin_message(self._identifier, {"power": self._telemetry.latest()})
+                finally:
+                        reset_priority(priority)
+                        reset_correlation_id(correlation)
+
+        def on_api_get(self, request):
+                if not Permissions.PLUGIN_DOMOTICZ_CONTROL.can():
+                        from flask import make_response
+                        return make_response("Insufficient rights", 403)
+
+                from flask import jsonify
+                return jsonify(
+                        states=self._state_cache.snapshot(),
+                        pending=self._scheduler.pending(),
+                        servers=self._client.health(),
+                        limits=self._client.limiter.stats(),
+                )
 
         def get_api_commands(self):
                 return {
                         "turnOn": ["ip", "idx"],
                         "turnOff": ["ip", "idx"],
                         "checkStatus": ["ip", "idx"],
+                        "checkAllStatuses": [],
+                        "cancelPending": ["id"],
+                        "turnOnGroup": ["name"],
+                        "turnOffGroup": ["name"],
+                        "cancelIdle": [],
                         "connectPrinter": [],
                         "disconnectPrinter": [],
                 }
 
         def on_api_command(self, command, data):
-                self._domoticz_logger.debug(data)
+                # id and priority tag the jobs started here, not later requests served by the same web thread
+                correlation = new_correlation_id("api")
+                # status checks from browsers queue behind switch commands at a busy server
+                priority = set_priority(PRIORITY_POLL if command in ("checkStatus", "checkAllStatuses") else PRIORITY_COMMAND)
+                try:
+                        return self._api_command(command, data)
+                finally:
+                        reset_priority(priority)
+                        reset_correlation_id(correlation)
+
+        def _api_command(self, command, data):
+                self._domoticz_logger.debug("API command %s: %s", command, data)
                 if not Permissions.PLUGIN_DOMOTICZ_CONTROL.can():
                         from flask import make_response
                         return make_response("Insufficient rights", 403)
 
-                # Find the plug config to get ignoreSSL
-                plug = self.plug_search(
-                        self._settings.get(["arrSmartplugs"]),
-                        "ip", data.get("ip", ""),
-                        "idx", data.get("idx", "")
-                )
-                ignoreSSL = plug["ignoreSSL"] if plug and "ignoreSSL" in plug else False
+                # configured plugs are switched with their stored credentials
+                entry = self._registry.get(data.get("ip"), data.get("idx"))
 
-                if command == "turnOn":
-                        if "username" in data and data["username"] != "":
-                                self._domoticz_logger.debug(
-                                        "Using authentication for %s." % "{ip}".format(**data)
-                                )
-                                self.turn_on(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL,
-                                        username="{username}".format(**data),
-                                        password="{password}".format(**data),
-                                        passcode="{passcode}".format(**data)
-                                )
-                        else:
-                                self.turn_on(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL,
-                                        passcode="{passcode}".format(**data)
-                                )
-                elif command == "turnOff":
-                        if "username" in data and data["username"] != "":
-                                self._domoticz_logger.debug(
-                                        "Using authentication for %s." % "{ip}".format(**data)
-                                )
-                                self.turn_off(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL,
-                                        username="{username}".format(**data),
-                                        password="{password}".format(**data),
-                                        passcode="{passcode}".format(**data)
-                                )
-                        else:
-                                self.turn_off(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL,
-                                        passcode="{passcode}".format(**data)
-                                )
+                if command in ("turnOn", "turnOff"):
+                        if entry is None:
+                                from flask import make_response
+                                return make_response("Unknown plug", 404)
+                        if entry.auth:
+                                self._domoticz_logger.debug("Using authentication for %s.", entry.plug["ip"])
+                        job = self._submit(
+                                self.turn_on if command == "turnOn" else self.turn_off,
+                                entry.plug["ip"],
+                                entry.plug["idx"],
+                                not entry.verify,
+                                username=entry.username,
+                                password=entry.password,
+                                passcode=entry.passcode,
+                        )
                 elif command == "checkStatus":
-                        if "username" in data and data["username"] != "":
-                                self._domoticz_logger.debug(
-                                        "Using authentication for %s." % "{ip}".format(**data)
-                                )
-                                self.check_status(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL,
-                                        username="{username}".format(**data),
-                                        password="{password}".format(**data),
+                        if entry is None:
+                                # not configured (yet), check with what the caller sent
+                                job = self._submit(
+                                        self.check_status,
+                                        data["ip"],
+                                        data["idx"],
+                                        False,
+                                        username=data.get("username", ""),
+                                        password=data.get("password", ""),
                                 )
                         else:
-                                self.check_status(
-                                        "{ip}".format(**data),
-                                        "{idx}".format(**data),
-                                        ignoreSSL
+                                job = self._submit(
+                                        self.check_status,
+                                        entry.plug["ip"],
+                                        entry.plug["idx"],
+                                        not entry.verify,
+                                        username=entry.username,
+                                        password=entry.password,
                                 )
+                elif command == "checkAllStatuses":
+                        job = self._submit(self.check_all_statuses)
+                elif command in ("turnOnGroup", "turnOffGroup"):
+                        job = self._submit(self.switch_group, data["name"], command == "turnOnGroup")
+                elif command == "cancelIdle":
+                        self._domoticz_logger.debug("Cancelling idle power off.")
+                        self._cancel_idle_timers()
+                        return
+                elif command == "cancelPending":
+                        from flask import jsonify
+                        return jsonify(cancelled=self._scheduler.cancel_id(int(data["id"])))
                 elif command == "connectPrinter":
                         self._domoticz_logger.debug("Connecting printer.")
                         self._printer.connect()
+                        return
                 elif command == "disconnectPrinter":
                         self._domoticz_logger.debug("Disconnecting printer.")
                         self._printer.disconnect()
+                        return
+                else:
+                        return
+
+                from flask import jsonify
+                return jsonify(job=job)
+
+        ##~~ BlueprintPlugin mixin
+
+        def is_blueprint_csrf_protected(self):
+                return True
+
+        @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+        def get_metrics(self):
+                from flask import Response, make_response
+                if not Permissions.PLUGIN_DOMOTICZ_CONTROL.can():
+                        return make_response("Insufficient rights", 403)
+                return Response(self._metrics.render(), mimetype="text/plain; version=0.0.4")
+
+        @octoprint.plugin.BlueprintPlugin.route("/telemetry", methods=["GET"])
+        def get_telemetry(self):
+                from flask import jsonify, make_response, request
+                if not Permissions.PLUGIN_DOMOTICZ_CONTROL.can():
+                        return make_response("Insufficient rights", 403)
+                try:
+                        points = int(request.args.get("points", 120))
+                        since = float(request.args["since"]) if "since" in request.args else None
+                except ValueError:
+                        return make_response("Invalid points or since", 400)
+                return jsonify(
+                        series=self._telemetry.series(points, since, request.args.get("ip"), request.args.get("idx")),
+                        jobs=self._telemetry.jobs(),
+                )
+
+        ##~~ EventHandlerPlugin mixin
+
+        def on_event(self, event, payload):
+                if event not in ("PrintStarted", "PrintResumed", "PrintDone", "PrintFailed"):
+                        return
+                correlation = new_correlation_id("event")
+                try:
+                        if event in ("PrintStarted", "PrintResumed"):
+                                self._cancel_idle_timers()
+                        else:
+                                self._start_idle_timers(event)
+
+                        if self._settings.get_boolean(["telemetryEnabled"]):
+                                self._record_job_event(event, payload)
+                finally:
+                        reset_correlation_id(correlation)
+
+        def _record_job_event(self, event, payload):
+                # the samples are status polls, they run next to the other polls
+                priority = set_priority(PRIORITY_POLL)
+                try:
+                        if event == "PrintStarted":
+                                self._telemetry.start_job((payload or {}).get("name"), time.time())
+                                # sample right away instead of waiting up to a poll interval
+                                self._submit(self._poll_statuses)
+                        elif event in ("PrintDone", "PrintFailed"):
+                                outcome = "done" if event == "PrintDone" else (payload or {}).get("reason", "failed")
+                                self._submit(self._finish_job, outcome)
+                finally:
+                        reset_priority(priority)
+
+        def _finish_job(self, outcome):
+                self._poll_statuses()
+                report = self._telemetry.finish_job(outcome, time.time())
+                if report is not None:
+                        self._domoticz_logger.debug("Print job %s used %s kWh.", report['name'], report['energy_kwh'])
+                        self._plugin_manager.send_plugin_message(self._identifier, {"job": report})
+
+        ##~~ Idle power off
+
+        def _start_idle_timers(self, reason):
+                for plug in self._registry.plugs():
+                        if plug.get("idleOff"):
+                                self._start_idle_timer(plug, reason)
+
+        def _start_idle_timer(self, plug, reason):
+                # a one shot timer per plug, restarted by every event ending a period of activity
+                timeout = float(plug["idleTimeout"]) * 60
+                self._domoticz_logger.debug("%s, powering off %s index %s after %.0fs idle.", reason, plug['ip'], plug['idx'], timeout)
+                self._scheduler.schedule(
+                        timeout, self._idle_timeout, [plug],
+                        key=plug_key(plug["ip"], plug["idx"]) + ("idle",),
+                        label=f"idle power off {plug['label'] or plug['idx']}",
+                )
+
+        def _cancel_idle_timers(self):
+                for plug in self._registry.plugs():
+                        self._cancel_pending(plug["ip"], plug["idx"], "idle")
+                with self._idle_lock:
+                        self._idle_cooling = {}
+
+        def _idle_timeout(self, plug):
+                if self._printer.is_printing() or self._printer.is_paused():
+                        return
+                if self._idle_temperature_exceeded(self._printer.get_current_temperatures()):
+                        # the temperature reports of the printer trigger the power off once it cooled down
+                        self._domoticz_logger.debug("Waiting for the printer to cool down before powering off %s index %s.", plug['ip'], plug['idx'])
+                        with self._idle_lock:
+                                self._idle_cooling[plug_key(plug["ip"], plug["idx"])] = plug
+                        return
+                self._idle_power_off(plug)
+
+        def _idle_power_off(self, plug):
+                if self._state_cache.get(plug["ip"], plug["idx"]) == "off":
+                        return
+                self._domoticz_logger.info("Powering off idle %s index %s.", plug['ip'], plug['idx'])
+                set_priority(PRIORITY_CRITICAL)
+                self.gcode_turn_off(plug)
+
+        def _idle_temperature_exceeded(self, temperatures):
+                # accepts the parsed reports of the temperature hook as well as the printer's current temperatures
+                threshold = self._settings.get_float(["idleTemperature"])
+                for value in (temperatures or {}).values():
+                        if isinstance(value, dict):
+                                actual, target = value.get("actual"), value.get("target")
+                        elif isinstance(value, (tuple, list)) and len(value) == 2:
+                                actual, target = value
+                        else:
+                                continue
+                        if (actual is not None and actual >= threshold) or (target is not None and target > 0):
+                                return True
+                return False
+
+        def process_temperatures(self, comm_instance, parsed_temperatures, *args, **kwargs):
+                # runs for every temperature report, only does work while a plug waits for the printer to cool down
+                if self._idle_cooling and not self._idle_temperature_exceeded(parsed_temperatures):
+                        with self._idle_lock:
+                                plugs, self._idle_cooling = self._idle_cooling, {}
+                        for plug in plugs.values():
+                                self._submit(self._idle_power_off, plug)
+                return parsed_temperatures
 
         ##~~ Gcode processing hook
 
         def process_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-                if gcode in ["M80", "M81"]:
-                        if cmd.startswith("M8") and cmd.count(" ") >= 2:
-                                plugip = cmd.split()[1]
-                                plugidx = cmd.split()[2]
-                                for plug in self._settings.get(["arrSmartplugs"]):
-                                        if (
-                                                        plug["ip"].upper() == plugip.upper()
-                                                        and plug["idx"] == plugidx
-                                                        and plug["gcodeEnabled"]
-                                        ):
-                                                if cmd.startswith("M80"):
-                                                        t = threading.Timer(
-                                                                int(plug["gcodeOnDelay"]),
-                                                                self.turn_on,
-                                                                [plug["ip"], plug["idx"], plug["ignoreSSL"]],
-                                                                {
-                                                                        "username": plug["username"],
-                                                                        "password": plug["password"],
-                                                                        "passcode": plug["passcode"]
-                                                                },
-                                                        )
-                                                        t.start()
-                                                        self._domoticz_logger.debug(
-                                                                "Received M80 command, attempting power on of %s index %s."
-                                                                % (plugip, plugidx)
-                                                        )
-                                                        return
-                                                elif cmd.startswith("M81"):
-                                                        t = threading.Timer(
-                                                                int(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug]
-                                                        )
-                                                        t.start()
-                                                        self._domoticz_logger.debug(
-                                                                "Received M81 command, attempting power off of %s index %s."
-                                                                % (plugip, plugidx)
-                                                        )
-                                                        return
-                                                else:
-                                                        return
-                elif cmd.startswith("@DOMOTICZ") and cmd.count(" ") == 1:
-                        plugidx = cmd.split()[1]
-                        for plug in self._settings.get(["arrSmartplugs"]):
-                                if plug["idx"] == plugidx and plug["gcodeEnabled"]:
-                                        if cmd.startswith("@DOMOTICZON"):
-                                                t = threading.Timer(
-                                                        int(plug["gcodeOnDelay"]),
-                                                        self.turn_on,
-                                                        [plug["ip"], plug["idx"]],
-                                                        {"username": plug["username"], "password": plug["password"], "passcode": plug["passcode"]},
-                                                )
-                                                t.start()
-                                                self._domoticz_logger.debug(
-                                                        "Received @DOMOTICZON command, attempting power on of %s index %s."
-                                                        % (plug["ip"], plugidx)
-                                                )
-                                                return
-                                        elif cmd.startswith("@DOMOTICZOFF"):
-                                                t = threading.Timer(
-                                                        int(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug]
-                                                )
-                                                t.start()
-                                                self._domoticz_logger.debug(
-                                                        "Received @DOMOTICZOFF command, attempting power off of %s index %s."
-                                                        % (plug["ip"], plugidx)
-                                                )
-                                                return
-                                        else:
-                                                return
+                # runs for every queued line, reject everything that can't be ours with a single prefix test
+                if not cmd.startswith(GCODE_PREFIXES) or not self._gcode_enabled:
+                        return
+
+                start = time.perf_counter()
+                # power commands from the printer go ahead of polls and api toggles at a throttled server,
+                # the actions scheduled here keep the priority, the comm thread doesn't
+                priority = set_priority(PRIORITY_CRITICAL)
+                correlation = new_correlation_id("gcode")
+                try:
+                        self._dispatch_gcode(cmd, gcode)
+                finally:
+                        reset_correlation_id(correlation)
+                        reset_priority(priority)
+                        self._metrics.gcode.record(time.perf_counter() - start)
+
+        def _dispatch_gcode(self, cmd, gcode):
+                parts = cmd.split()
+                if gcode in ("M80", "M81"):
+                        if len(parts) < 3:
+                                return
+                        plug = self._gcode_plugs.get((parts[1].upper(), parts[2]))
+                        if plug is None:
+                                return
+                        if gcode == "M80":
+                                self._gcode_power_on(plug, "M80")
+                        else:
+                                self._gcode_power_off(plug, "M81")
+                elif parts[0] in ("@DOMOTICZGROUPON", "@DOMOTICZGROUPOFF") and len(parts) >= 2:
+                        name = cmd.split(None, 1)[1].strip()
+                        if name not in self._gcode_groups:
+                                return
+                        self._domoticz_logger.debug("Received %s command for group %s.", parts[0], name)
+                        self._submit(self.switch_group, name, parts[0] == "@DOMOTICZGROUPON", source="gcode")
+                elif parts[0] in ("@DOMOTICZON", "@DOMOTICZOFF") and len(parts) == 2:
+                        plug = self._gcode_plugs_by_idx.get(parts[1])
+                        if plug is None:
+                                return
+                        if parts[0] == "@DOMOTICZON":
+                                self._gcode_power_on(plug, "@DOMOTICZON")
+                        else:
+                                self._gcode_power_off(plug, "@DOMOTICZOFF")
+
+        def _gcode_power_on(self, plug, source):
+                self._schedule(
+                        float(plug["gcodeOnDelay"]),
+                        self.turn_on,
+                        [plug["ip"], plug["idx"], plug["ignoreSSL"]],
+                        {"username": plug["username"], "password": plug["password"], "passcode": plug["passcode"]},
+                        key=plug_key(plug["ip"], plug["idx"]) + ("power",),
+                )
+                self._domoticz_logger.debug(
+                        "Received %s command, attempting power on of %s index %s.", source, plug["ip"], plug["idx"]
+                )
+
+        def _gcode_power_off(self, plug, source):
+                self._schedule(
+                        float(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug],
+                        key=plug_key(plug["ip"], plug["idx"]) + ("power",),
+                )
+                self._domoticz_logger.debug(
+                        "Received %s command, attempting power off of %s index %s.", source, plug["ip"], plug["idx"]
+                )
+
+        def _rebuild_gcode_index(self):
+                # only gcode enabled plugs are dispatchable, first configured plug wins like the old linear scan
+                by_address = {}
+                by_idx = {}
+                for plug in self._registry.plugs():
+                        if not plug.get("gcodeEnabled"):
+                                continue
+                        by_address.setdefault((plug["ip"].upper(), plug["idx"]), plug)
+                        by_idx.setdefault(plug["idx"], plug)
+                self._gcode_plugs = by_address
+                self._gcode_plugs_by_idx = by_idx
+                self._gcode_groups = {
+                        group["name"]: group for group in self._settings.get(["arrGroups"]) if group.get("gcodeEnabled", True)
+                }
+                self._gcode_enabled = bool(by_idx or self._gcode_groups)
+
+        ##~~ Background execution
+
+        def _submit(self, fn, *args, **kwargs):
+                job_id = next(self._job_ids)
+                # polls and status checks can fill their workers, everything else has its own so a power off
+                # never waits for them
+                executor = self._executor if request_priority.get() == PRIORITY_POLL else self._command_executor
+                # keeps the correlation id and priority of the request or event the job was started for
+                future = executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+                future.add_done_callback(lambda f: self._job_done(job_id, fn, f))
+                return job_id
+
+        def _schedule(self, delay, fn, args=(), kwargs=None, key=None):
+                if delay <= 0:
+                        if key is not None:
+                                self._scheduler.cancel(key)
+                        return self._submit(fn, *args, **(kwargs or {}))
+                return self._scheduler.schedule(delay, fn, args, kwargs, key=key)
+
+        def _cancel_pending(self, plug_ip, plug_idx, *kinds):
+                for kind in kinds:
+                        if self._scheduler.cancel(plug_key(plug_ip, plug_idx) + (kind,)):
+                                self._domoticz_logger.debug("Cancelled pending %s action of %s index %s.", kind, plug_ip, plug_idx)
+
+        def _job_done(self, job_id, fn, future):
+                exc = future.exception()
+                if exc is not None:
+                        self._domoticz_logger.error(
+                                "Job %s (%s) failed.", job_id, fn.__name__, exc_info=(type(exc), exc, exc.__traceback__)
+                        )
+
+        ##~~ Plug groups
+
+        def switch_group(self, name, on, source="api"):
+                action = "on" if on else "off"
+                group = next((group for group in self._settings.get(["arrGroups"]) if group["name"] == name), None)
+                if group is None:
+                        self._domoticz_logger.warning("Unknown group %s.", name)
+                        self._plugin_manager.send_plugin_message(
+                                self._identifier, {"group": {"name": name, "action": action, "results": [], "ok": False}}
+                        )
+                        return
+
+                results = []
+                stages = {}
+                for member in group.get("members", []):
+                        plug = self._registry.plug(member["ip"], member["idx"])
+                        if plug is None:
+                                self._domoticz_logger.warning("Group %s refers to unknown plug %s index %s.", name, member['ip'], member['idx'])
+                                results.append({"currentState": "unknown", "ip": member["ip"], "idx": member["idx"]})
+                                continue
+                        stages.setdefault(self.group_stage(member), []).append(plug)
+
+                # members of a stage switch concurrently, stages run in order and in reverse order for off
+                start = time.monotonic()
+                for stage in sorted(stages, reverse=not on):
+                        futures = [
+                                self._group_executor.submit(contextvars.copy_context().run, self._switch_group_member, plug, on, source)
+                                for plug in stages[stage]
+                        ]
+                        for plug, future in zip(stages[stage], futures):
+                                try:
+                                        state = future.result()
+                                except Exception:
+                                        self._domoticz_logger.error("Error switching %s index %s of group %s.", plug['ip'], plug['idx'], name, exc_info=True)
+                                        state = "unknown"
+                                results.append({"currentState": state, "ip": plug["ip"], "idx": plug["idx"]})
+
+                duration = time.monotonic() - start
+                self._domoticz_logger.debug("Switched group %s %s in %.3fs.", name, action, duration)
+                self._plugin_manager.send_plugin_message(
+                        self._identifier,
+                        {
+                                "group": {
+                                        "name": name,
+                                        "action": action,
+                                        "results": results,
+                                        "ok": all(result["currentState"] == action for result in results),
+                                        "duration": round(duration, 3),
+                                }
+                        },
+                )
+                return results
+
+        def _switch_group_member(self, plug, on, source):
+                credentials = {"username": plug["username"], "password": plug["password"], "passcode": plug["passcode"]}
+                if on:
+                        return self.turn_on(plug["ip"], plug["idx"], plug["ignoreSSL"], **credentials)
+                if source == "gcode" and plug["warnPrinting"] and self._printer.is_printing():
+                        self._domoticz_logger.debug("Not powering off %s since new print has started.", plug['label'])
+                        return self._state_cache.get(plug["ip"], plug["idx"]) or "unknown"
+                delay = self._prepare_off(plug["ip"], plug["idx"])
+                if delay > 0:
+                        # wait for the printer to disconnect like turn_off does, on the plug's power key so a
+                        # later command for the plug cancels the power off. The release runs on the scheduler
+                        # thread, a group blocking all workers can't hold it up.
+                        released = Future()
+                        self._scheduler.schedule(
+                                delay, released.set_result, [True],
+                                key=plug_key(plug["ip"], plug["idx"]) + ("power",),
+                                label=f"group power off {plug['label'] or plug['idx']}",
+                                on_cancel=lambda: released.done() or released.set_result(False),
+                                inline=True,
+                        )
+                        if not released.result():
+                                self._domoticz_logger.debug("Power off of %s index %s superseded.", plug["ip"], plug["idx"])
+                                return self._state_cache.get(plug["ip"], plug["idx"]) or "unknown"
+                return self._switch_off(plug["ip"], plug["idx"], plug["ignoreSSL"], **credentials)
+
+        ##~~ Push updates
+
+        def _start_push_subscriber(self):
+                helpers = self._plugin_manager.get_helpers("mqtt", "mqtt_subscribe", "mqtt_unsubscribe")
+                if self._mqtt_topic is not None and helpers and "mqtt_unsubscribe" in helpers:
+                        helpers["mqtt_unsubscribe"](self._on_mqtt_subscription, topic=self._mqtt_topic)
+                self._mqtt_topic = None
+
+                # the feed only carries the device idx, map it to the plugs of the server it belongs to
+                server = self._settings.get(["mqttServer"]).rstrip("/").upper()
+                push_plugs = {}
+                for plug in self._registry.plugs():
+                        if plug["ip"] == "" or (server and plug["ip"].rstrip("/").upper() != server):
+                                continue
+                        if self.switch_param(plug) != "switchlight":
+                                # the feed reports devices, scene indexes would collide with them
+                                continue
+                        push_plugs.setdefault(plug["idx"], []).append(plug)
+                self._push_plugs = push_plugs
+
+                if not self._settings.get_boolean(["mqttEnabled"]):
+                        return
+                if not helpers or "mqtt_subscribe" not in helpers:
+                        self._logger.warning("MQTT push updates are enabled but the MQTT plugin is not installed, falling back to polling.")
                         return
 
+                topic = self._settings.get(["mqttTopic"])
+                helpers["mqtt_subscribe"](topic, self._on_mqtt_subscription)
+                self._mqtt_topic = topic
+                self._domoticz_logger.debug("Subscribed to Domoticz updates on %s.", topic)
+
+        def _on_mqtt_subscription(self, topic, message, retained=None, qos=None, *args, **kwargs):
+                try:
+                        payload = json.loads(message)
+                        plugs = self._push_plugs.get(str(payload["idx"]))
+                except (ValueError, TypeError, KeyError):
+                        return
+                if not plugs:
+                        return
+
+                correlation = new_correlation_id("push")
+                try:
+                        state = self.state_from_nvalue(payload.get("nvalue"))
+                        for plug in plugs:
+                                if self._state_cache.update(plug["ip"], plug["idx"], state):
+                                        self._domoticz_logger.debug("%s index %s is %s (pushed)", plug['ip'], plug['idx'], state)
+                                        self._queue_state(plug["ip"], plug["idx"], state)
+                finally:
+                        reset_correlation_id(correlation)
+
+        ##~~ System commands
+
+        def _start_command_runner(self):
+                if self._command_runner is not None:
+                        # commands already running keep going on the old pool
+                        self._command_runner.shutdown()
+                self._command_runner = SystemCommandRunner(
+                        self._domoticz_logger,
+                        self._report_system_command,
+                        max_concurrent=self._settings.get_int(["sysCmdMaxConcurrent"]),
+                        timeout=self._settings.get_int(["sysCmdTimeout"]),
+                )
+
+        def _run_system_command(self, cmd, plug, kind):
+                self._command_runner.run(cmd, ip=plug["ip"], idx=plug["idx"], kind=kind)
+
+        def _report_system_command(self, result):
+                self._plugin_manager.send_plugin_message(self._identifier, {"sysCmd": result})
+
         ##~~ Utility functions
 
         def lookup(self, dic, key, *keys):
@@ -447,10 +1276,40 @@ class domoticzPlugin(
                         return self.lookup(dic.get(key, {}), *keys)
                 return dic.get(key)
 
-        def plug_search(self, search_list, key1, value1, key2, value2):
-                for item in search_list:
-                        if item[key1] == value1 and item[key2] == value2:
-                                return item
+        def switch_param(self, plug):
+                # scenes and groups are switched by Domoticz itself, all members in one request
+                if plug is not None and plug.get("type") == "scene":
+                        return "switchscene"
+                return "switchlight"
+
+        def scene_statuses(self, response):
+                # a group with only some members on reports Mixed, the plug still supplies power then
+                return {
+                        str(scene["idx"]): "On" if scene.get("Status") == "Mixed" else scene.get("Status")
+                        for scene in response.get("result", [])
+                }
+
+        def state_from_nvalue(self, nvalue):
+                # switch devices report 0 for off, 1 for on and 2 for a dimmer level, which is on as well
+                if nvalue == 0:
+                        return "off"
+                elif nvalue in (1, 2):
+                        return "on"
+                return "unknown"
+
+        def state_from_status(self, status):
+                if status == "On":
+                        return "on"
+                elif status == "Off":
+                        return "off"
+                return "unknown"
+
+        def group_stage(self, member):
+                # missing, blank or invalid stages switch with stage 0
+                try:
+                        return int(member.get("stage") or 0)
+                except (TypeError, ValueError):
+                        return 0
 
         ##~~ Access Permissions Hook
 
@@ -503,6 +1362,7 @@ def __plugin_load__():
         global __plugin_hooks__
         __plugin_hooks__ = {
                 "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.process_gcode,
+                "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.process_temperatures,
                 "octoprint.access.permissions": __plugin_implementation__.get_additional_permissions,
                 "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         }
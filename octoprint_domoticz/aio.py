@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import asyncio
+import concurrent.futures
+import functools
+import importlib.util
+import json
+import threading
+
+from .client import DomoticzRequestError
+from .limiter import request_priority
+
+
+def available():
+        # looked up without importing it, aiohttp is only loaded once the engine sends a request
+        return importlib.util.find_spec("aiohttp") is not None
+
+
+class AsyncEngine(object):
+        """
+        Runs batches of Domoticz requests concurrently on an event loop in a thread of its own, so a
+        sweep over many servers takes about as long as the slowest of them. Circuit breakers, adaptive
+        timeouts and metrics are shared with the DomoticzClient the engine is attached to.
+
+        Callers on any thread hand in a batch and block until all of its requests are done. Stopping
+        the engine cancels the batches in flight, their callers get None and fall back to the client.
+        """
+
+        def __init__(self, client, limit_per_host=4):
+                self._client = client
+                self._limit_per_host = limit_per_host
+                self._loop = None
+                self._thread = None
+                self._sessions = {}
+                self._pending = set()
+                self._lock = threading.Lock()
+
+        def start(self):
+                with self._lock:
+                        if self._loop is not None:
+                                return
+                        loop = asyncio.new_event_loop()
+                        self._thread = threading.Thread(target=self._run, args=(loop,), name="domoticz.aio", daemon=True)
+                        self._thread.start()
+                        self._loop = loop
+
+        def stop(self):
+                with self._lock:
+                        loop, self._loop = self._loop, None
+                        pending = list(self._pending)
+                if loop is None:
+                        return
+
+                for future in pending:
+                        future.cancel()
+                try:
+                        asyncio.run_coroutine_threadsafe(self._close_sessions(), loop).result(timeout=5)
+                except Exception:
+                        pass
+                loop.call_soon_threadsafe(loop.stop)
+                self._thread.join(timeout=5)
+                if not self._thread.is_alive():
+                        loop.close()
+
+        def gather(self, calls):
+                """
+                Runs (base_url, query, username, password, verify) calls and returns their (response, json)
+                results in order, exceptions in place of the results of failed calls, or None if the engine
+                was stopped before the batch finished.
+                """
+                # tasks on the loop don't see the caller's context, its request priority is handed over
+                priority = request_priority.get()
+                with self._lock:
+                        if self._loop is None:
+                                return None
+                        future = asyncio.run_coroutine_threadsafe(self._gather(calls, priority), self._loop)
+                        self._pending.add(future)
+                try:
+                        return future.result()
+                except concurrent.futures.CancelledError:
+                        return None
+                finally:
+                        with self._lock:
+                                self._pending.discard(future)
+
+        def _run(self, loop):
+                asyncio.set_event_loop(loop)
+                loop.run_forever()
+
+        async def _gather(self, calls, priority):
+                return await asyncio.gather(*(self._get_json(priority, *call) for call in calls), return_exceptions=True)
+
+        async def _get_json(self, priority, base_url, query, username="", password="", verify=True):
+                import aiohttp
+
+                begin = functools.partial(self._client.begin_request, base_url, query, priority=priority)
+                if self._client.limiter.enabled:
+                        # waiting for the rate limiter blocks, keep it off the loop
+                        request = await asyncio.get_running_loop().run_in_executor(None, begin)
+                else:
+                        request = begin()
+                try:
+                        async with self._session(verify).get(
+                                f"{base_url}/json.htm?{query}",
+                                auth=aiohttp.BasicAuth(username, password) if username else None,
+                                timeout=aiohttp.ClientTimeout(total=request.timeout),
+                        ) as web_response:
+                                text = await web_response.text()
+                except asyncio.TimeoutError:
+                        request.failed("timeout")
+                        raise DomoticzRequestError(f"Request to {base_url} timed out after {request.timeout:.1f}s")
+                except aiohttp.ClientConnectionError as e:
+                        request.failed("connection")
+                        raise DomoticzRequestError(str(e))
+                except aiohttp.ClientError as e:
+                        request.failed("error")
+                        raise DomoticzRequestError(str(e))
+                return web_response, request.completed(web_response.status, lambda: json.loads(text))
+
+        def _session(self, verify):
+                # only ever called on the loop thread, credentials go with each request
+                session = self._sessions.get(verify)
+                if session is None:
+                        import aiohttp
+
+                        connector = aiohttp.TCPConnector(limit_per_host=self._limit_per_host, ssl=None if verify else False)
+                        session = self._sessions[verify] = aiohttp.ClientSession(connector=connector)
+                return session
+
+        async def _close_sessions(self):
+                sessions, self._sessions = list(self._sessions.values()), {}
+                for session in sessions:
+                        await session.close()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .limiter import RateLimiter
+
+
+class DomoticzRequestError(Exception):
+        """Raised when a Domoticz server could not be reached or did not answer in time."""
+
+
+class CircuitOpenError(DomoticzRequestError):
+        """Raised without contacting the server while its circuit breaker is open."""
+
+
+class _Latency(object):
+        """Smoothed latency of one command, and how often its timeout was doubled since it last succeeded."""
+
+        __slots__ = ("latency", "deviation", "backoff")
+
+        def __init__(self):
+                self.latency = None
+                self.deviation = 0.0
+                self.backoff = 1
+
+        def add(self, latency):
+                if self.latency is None:
+                        self.latency = latency
+                        self.deviation = latency / 2
+                else:
+                        self.deviation = 0.75 * self.deviation + 0.25 * abs(latency - self.latency)
+                        self.latency = 0.875 * self.latency + 0.125 * latency
+                self.backoff = 1
+
+
+class ServerHealth(object):
+        """
+        Circuit breaker and latency tracker for one Domoticz server.
+
+        After ``failure_threshold`` consecutive failures the circuit opens and requests fail fast for
+        ``reset_timeout`` seconds, then a single probe request is let through to detect recovery.
+        The request timeout follows the observed latency of each command the way TCP derives its
+        retransmission timeout (smoothed latency plus four deviations), clamped to [min_timeout,
+        max_timeout]. Like TCP it doubles after every timeout until the command answers again, and
+        probes use max_timeout, so a server that got slower than its history isn't locked out.
+        """
+
+        CLOSED = "closed"
+        OPEN = "open"
+        HALF_OPEN = "half-open"
+
+        def __init__(self, failure_threshold=3, reset_timeout=30, min_timeout=2, max_timeout=10):
+                self.failure_threshold = failure_threshold
+                self.reset_timeout = reset_timeout
+                self.min_timeout = min_timeout
+                self.max_timeout = max_timeout
+                self.state = self.CLOSED
+                self.failures = 0
+                self._latencies = {}
+                self._opened_at = 0
+                self._probing = False
+                self._lock = threading.Lock()
+
+        def before_request(self):
+                with self._lock:
+                        if self.state == self.CLOSED:
+                                return
+                        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                                self.state = self.HALF_OPEN
+                                self._probing = False
+                        if self.state == self.HALF_OPEN and not self._probing:
+                                self._probing = True
+                                return
+                raise CircuitOpenError("circuit open after %d failures" % self.failures)
+
+        def record_success(self, latency, command="other"):
+                with self._lock:
+                        self._latency(command).add(latency)
+                        self.failures = 0
+                        self.state = self.CLOSED
+                        self._probing = False
+
+        def record_failure(self, command="other", timed_out=False):
+                with self._lock:
+                        if timed_out:
+                                estimate = self._latency(command)
+                                if self._timeout(estimate) < self.max_timeout:
+                                        estimate.backoff *= 2
+                        self.failures += 1
+                        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                                self.state = self.OPEN
+                                self._opened_at = time.monotonic()
+                        self._probing = False
+
+        def timeout(self, command="other"):
+                if self.state != self.CLOSED:
+                        return self.max_timeout
+                return self._timeout(self._latencies.get(command))
+
+        def _timeout(self, estimate):
+                if estimate is None or estimate.latency is None:
+                        return self.max_timeout
+                timeout = max(self.min_timeout, estimate.latency + 4 * estimate.deviation) * estimate.backoff
+                return min(self.max_timeout, timeout)
+
+        def _latency(self, command):
+                estimate = self._latencies.get(command)
+                if estimate is None:
+                        estimate = self._latencies[command] = _Latency()
+                return estimate
+
+        def as_dict(self):
+                with self._lock:
+                        latencies = list(self._latencies.items())
+                return {
+                        "state": self.state,
+                        "failures": self.failures,
+                        "commands": {
+                                command: {
+                                        "latency_ms": round(estimate.latency * 1000, 1) if estimate.latency is not None else None,
+                                        "timeout_s": round(self._timeout(estimate), 2),
+                                }
+                                for command, estimate in sorted(latencies)
+                        },
+                }
+
+
+class _Request(object):
+        """Health and metrics bookkeeping of a single request, shared by the blocking and the asynchronous path."""
+
+        __slots__ = ("client", "base_url", "server", "command", "health", "timeout", "start")
+
+        def __init__(self, client, base_url, server, command, health, timeout):
+                self.client = client
+                self.base_url = base_url
+                self.server = server
+                self.command = command
+                self.health = health
+                self.timeout = timeout
+                self.start = time.monotonic()
+
+        def failed(self, result):
+                self.health.record_failure(self.command, timed_out=result == "timeout")
+                self.client._observe(self.server, self.command, result, time.monotonic() - self.start)
+
+        def completed(self, status_code, parse):
+                elapsed = time.monotonic() - self.start
+                if status_code >= 500:
+                        self.health.record_failure(self.command)
+                        self.client._observe(self.server, self.command, "http_5xx", elapsed)
+                        raise DomoticzRequestError(f"HTTP {status_code} from {self.base_url}")
+                self.health.record_success(elapsed, self.command)
+
+                try:
+                        response = parse()
+                except ValueError:
+                        self.client._observe(self.server, self.command, "invalid_response", elapsed)
+                        raise
+                self.client._observe(self.server, self.command, "ok", elapsed)
+                return response
+
+
+class DomoticzClient(object):
+        """
+        Keeps one pooled keep-alive session per Domoticz server so repeated switch and status
+        calls reuse the TCP/TLS connection instead of opening a new one every time.
+
+        Sessions are keyed by base url, credentials and certificate verification, the latter
+        two are bound to the session when it is created. Every server also gets a ServerHealth
+        so one unreachable hub fails fast instead of stalling callers for the full timeout, and
+        requests pass the RateLimiter before they are sent.
+        """
+
+        def __init__(self, pool_maxsize=4, metrics=None):
+                self._pool_maxsize = pool_maxsize
+                self._metrics = metrics
+                self._engine = None
+                self.limiter = RateLimiter(metrics=metrics)
+                self._sessions = {}
+                self._health = {}
+                self._health_options = {}
+                self._lock = threading.Lock()
+
+        def configure(self, **health_options):
+                with self._lock:
+                        self._health_options = health_options
+                        self._health = {}
+
+        def set_engine(self, engine):
+                """Runs get_json_many on an asynchronous engine, None goes back to one request after the other."""
+                self._engine = engine
+
+        def get_json(self, base_url, query, username="", password="", verify=True, timeout=None):
+                import requests
+
+                request = self.begin_request(base_url, query, timeout)
+                session = self._session(base_url, username, password, verify)
+                try:
+                        web_response = session.get(f"{base_url}/json.htm?{query}", timeout=request.timeout)
+                except requests.RequestException as e:
+                        if isinstance(e, requests.Timeout):
+                                request.failed("timeout")
+                        elif isinstance(e, requests.ConnectionError):
+                                request.failed("connection")
+                        else:
+                                request.failed("error")
+                        raise DomoticzRequestError(str(e))
+                except Exception:
+                        request.failed("error")
+                        raise
+                return web_response, request.completed(web_response.status_code, web_response.json)
+
+        def get_json_many(self, calls):
+                """
+                Runs (base_url, query, username, password, verify) calls and returns their (response, json)
+                results in order, exceptions in place of the results of failed calls.
+                """
+                engine = self._engine
+                if engine is not None:
+                        results = engine.gather(calls)
+                        if results is not None:
+                                return results
+                results = []
+                for call in calls:
+                        try:
+                                results.append(self.get_json(*call))
+                        except Exception as e:
+                                results.append(e)
+                return results
+
+        def begin_request(self, base_url, query, timeout=None, priority=None):
+                """
+                Checks the circuit of the server, waits for the rate limiter and returns the bookkeeping
+                of one request to it. The priority defaults to the one set for the calling context.
+                """
+                server = base_url.rstrip("/").lower()
+                command = query.split("param=", 1)[1].split("&", 1)[0] if "param=" in query else "other"
+                health = self.health_for(base_url)
+                try:
+                        health.before_request()
+                except CircuitOpenError:
+                        self._observe(server, command, "circuit_open")
+                        raise
+                self.limiter.acquire(server, priority)
+                return _Request(self, base_url, server, command, health, timeout if timeout is not None else health.timeout(command))
+
+        def _observe(self, server, command, result, seconds=None):
+                if self._metrics is not None:
+                        self._metrics.observe_request(server, command, result, seconds)
+
+        def health_for(self, base_url):
+                key = base_url.rstrip("/").lower()
+                health = self._health.get(key)
+                if health is None:
+                        with self._lock:
+                                health = self._health.setdefault(key, ServerHealth(**self._health_options))
+                return health
+
+        def health(self):
+                return {server: health.as_dict() for server, health in list(self._health.items())}
+
+        def reset(self):
+                with self._lock:
+                        sessions = list(self._sessions.values())
+                        self._sessions = {}
+                for session in sessions:
+                        session.close()
+
+        def _session(self, base_url, username, password, verify):
+                key = (base_url.rstrip("/").lower(), username, password if username else "", verify)
+                session = self._sessions.get(key)
+                if session is not None:
+                        return session
+
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                with self._lock:
+                        session = self._sessions.get(key)
+                        if session is None:
+                                session = requests.Session()
+                                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_maxsize)
+                                session.mount("http://", adapter)
+                                session.mount("https://", adapter)
+                                session.verify = verify
+                                if username:
+                                        session.auth = (username, password)
+                                self._sessions[key] = session
+                return session
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+import threading
+
+
+class _Call(object):
+        __slots__ = ("intent", "event", "result", "error", "callbacks")
+
+        def __init__(self, intent=None):
+                self.intent = intent
+                self.event = threading.Event()
+                self.result = None
+                self.error = None
+                self.callbacks = []
+
+        def wait(self):
+                self.event.wait()
+                if self.error is not None:
+                        raise self.error
+                return self.result
+
+        def run(self, fn, args, kwargs):
+                try:
+                        self.result = fn(*args, **kwargs)
+                except BaseException as e:
+                        self.error = e
+                        raise
+                finally:
+                        self.event.set()
+                return self.result
+
+
+class SingleFlight(object):
+        """Concurrent calls with the same key share one execution and its result or exception."""
+
+        def __init__(self, logger=None):
+                self._logger = logger or logging.getLogger(__name__)
+                self._calls = {}
+                self._lock = threading.Lock()
+
+        def do(self, key, fn, *args, **kwargs):
+                """Returns the result and whether it was shared with a call already in flight."""
+                with self._lock:
+                        call = self._calls.get(key)
+                        if call is None:
+                                call = self._calls[key] = _Call()
+                                leader = True
+                        else:
+                                leader = False
+                if not leader:
+                        return call.wait(), True
+
+                try:
+                        return call.run(fn, args, kwargs), False
+                finally:
+                        self._finish(key, call)
+
+        def do_or_join(self, key, callback, fn, *args, **kwargs):
+                """
+                Like do, but hands the result to ``callback(result, error)``. If a call with the same key
+                is in flight the callback is attached to it and this returns at once instead of waiting,
+                so a worker isn't held by a caller that only needs the result. Returns whether the call
+                was shared.
+                """
+                with self._lock:
+                        call = self._calls.get(key)
+                        if call is not None:
+                                call.callbacks.append(callback)
+                                return True
+                        call = self._calls[key] = _Call()
+                        call.callbacks.append(callback)
+
+                try:
+                        call.run(fn, args, kwargs)
+                except Exception:
+                        pass
+                finally:
+                        self._finish(key, call)
+                return False
+
+        def _finish(self, key, call):
+                # callbacks are only attached while the call is registered, none can be missed after this
+                with self._lock:
+                        del self._calls[key]
+                        callbacks, call.callbacks = call.callbacks, []
+                for callback in callbacks:
+                        try:
+                                callback(call.result, call.error)
+                        except Exception:
+                                self._logger.exception("Callback of a shared call failed.")
+
+
+class _Device(object):
+        __slots__ = ("lock", "ticket", "running")
+
+        def __init__(self):
+                self.lock = threading.Lock()
+                self.ticket = 0
+                self.running = None
+
+
+class LatestIntent(object):
+        """
+        Serializes commands per device so on and off never race each other on the relay. A command
+        arriving while the same one is in flight shares its result, and of the commands queued
+        behind a running one only the most recent is sent, the others are dropped as superseded.
+        """
+
+        SUPERSEDED = object()
+
+        def __init__(self):
+                self._devices = {}
+                self._lock = threading.Lock()
+
+        def run(self, key, intent, fn, *args, **kwargs):
+                """Returns the result of ``fn``, or SUPERSEDED if a later command took its place."""
+                with self._lock:
+                        device = self._devices.get(key)
+                        if device is None:
+                                device = self._devices[key] = _Device()
+                        device.ticket += 1
+                        ticket = device.ticket
+                        running = device.running
+                if running is not None and running.intent == intent:
+                        return running.wait()
+
+                with device.lock:
+                        with self._lock:
+                                if device.ticket != ticket:
+                                        return self.SUPERSEDED
+                                call = device.running = _Call(intent)
+                        try:
+                                return call.run(fn, args, kwargs)
+                        finally:
+                                with self._lock:
+                                        device.running = None
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SystemCommandRunner(object):
+        """
+        Runs the sysRunCmdOn/sysRunCmdOff hooks as subprocesses on a small pool of its own, so a hung
+        script can neither pile up threads nor hold up the workers switching the plugs.
+
+        Output is captured into the debug log, commands running longer than the timeout are killed
+        together with their children and every run is reported to ``report`` with its exit code
+        and duration.
+        """
+
+        def __init__(self, logger, report, max_concurrent=2, timeout=60):
+                self._logger = logger
+                self._report = report
+                self._timeout = timeout
+                self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent), thread_name_prefix="domoticz.cmd")
+
+        def run(self, cmd, **context):
+                return self._executor.submit(self._run, cmd, context)
+
+        def shutdown(self):
+                self._executor.shutdown(wait=False)
+
+        def _run(self, cmd, context):
+                self._logger.debug("Running system command: %s", cmd)
+                start = time.monotonic()
+                timed_out = False
+                try:
+                        proc = subprocess.Popen(
+                                cmd,
+                                shell=True,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=os.name == "posix",
+                        )
+                except OSError:
+                        self._logger.error("Could not start system command: %s", cmd, exc_info=True)
+                        self._report(dict(context, cmd=cmd, returncode=None, duration=0, timedOut=False))
+                        return
+
+                try:
+                        output, _ = proc.communicate(timeout=self._timeout if self._timeout > 0 else None)
+                except subprocess.TimeoutExpired:
+                        timed_out = True
+                        self._kill(proc)
+                        output, _ = proc.communicate()
+
+                duration = time.monotonic() - start
+                for line in output.decode("utf-8", "replace").splitlines():
+                        self._logger.debug("[%s] %s", cmd, line)
+
+                if timed_out:
+                        self._logger.error("System command timed out after %ss: %s", self._timeout, cmd)
+                elif proc.returncode != 0:
+                        self._logger.error("System command exited with %s after %.2fs: %s", proc.returncode, duration, cmd)
+                else:
+                        self._logger.debug("System command finished in %.2fs: %s", duration, cmd)
+
+                self._report(
+                        dict(context, cmd=cmd, returncode=proc.returncode, duration=round(duration, 3), timedOut=timed_out)
+                )
+
+        def _kill(self, proc):
+                try:
+                        if os.name == "posix":
+                                os.killpg(proc.pid, signal.SIGKILL)
+                        else:
+                                proc.kill()
+                except OSError:
+                        pass
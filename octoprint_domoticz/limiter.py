@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+# lower values are sent first
+PRIORITY_CRITICAL = 0
+PRIORITY_COMMAND = 1
+PRIORITY_POLL = 2
+
+PRIORITY_NAMES = {PRIORITY_CRITICAL: "critical", PRIORITY_COMMAND: "command", PRIORITY_POLL: "poll"}
+
+request_priority = contextvars.ContextVar("domoticz_request_priority", default=PRIORITY_COMMAND)
+
+
+def set_priority(priority):
+        """
+        Sets the priority of the requests sent from this context, including work handed to the plugin's
+        pools, and returns a token for reset_priority.
+        """
+        return request_priority.set(priority)
+
+
+def reset_priority(token):
+        request_priority.reset(token)
+
+
+class TokenBucket(object):
+        """Allows ``burst`` requests at once and ``rate`` requests per second on average."""
+
+        def __init__(self, rate, burst):
+                self.rate = rate
+                self.burst = max(1, burst)
+                self.tokens = float(self.burst)
+                self._updated = time.monotonic()
+
+        def available(self, now):
+                return min(self.burst, self.tokens + (now - self._updated) * self.rate)
+
+        def take(self, now):
+                """Takes a token and returns 0, or returns the seconds until one is available."""
+                self.tokens = self.available(now)
+                self._updated = now
+                if self.tokens >= 1:
+                        self.tokens -= 1
+                        return 0
+                return (1 - self.tokens) / self.rate
+
+
+class _WaitStats(object):
+        __slots__ = ("count", "total", "max")
+
+        def __init__(self):
+                self.count = 0
+                self.total = 0.0
+                self.max = 0.0
+
+        def add(self, seconds):
+                self.count += 1
+                self.total += seconds
+                self.max = max(self.max, seconds)
+
+        def as_dict(self):
+                return {
+                        "count": self.count,
+                        "avg_ms": round(self.total / self.count * 1000, 1) if self.count else None,
+                        "max_ms": round(self.max * 1000, 1),
+                }
+
+
+class _ServerQueue(object):
+        """Requests waiting for a token of one server, the head of the heap is the only one taking tokens."""
+
+        def __init__(self, rate, burst):
+                self.bucket = TokenBucket(rate, burst)
+                self.waiting = []
+                self.waits = {}
+                self.closed = False
+                self.cond = threading.Condition()
+
+        def acquire(self, priority, ticket):
+                start = time.monotonic()
+                entry = (priority, ticket)
+                with self.cond:
+                        heapq.heappush(self.waiting, entry)
+                        try:
+                                while not self.closed:
+                                        if self.waiting[0] != entry:
+                                                self.cond.wait()
+                                                continue
+                                        delay = self.bucket.take(time.monotonic())
+                                        if delay <= 0:
+                                                break
+                                        self.cond.wait(delay)
+                        finally:
+                                self.waiting.remove(entry)
+                                heapq.heapify(self.waiting)
+                                self.cond.notify_all()
+                        waited = time.monotonic() - start
+                        stats = self.waits.get(priority)
+                        if stats is None:
+                                stats = self.waits[priority] = _WaitStats()
+                        stats.add(waited)
+                return waited
+
+        def close(self):
+                with self.cond:
+                        self.closed = True
+                        self.cond.notify_all()
+
+        def as_dict(self):
+                with self.cond:
+                        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+                        for priority, _ in self.waiting:
+                                queued[PRIORITY_NAMES.get(priority, str(priority))] += 1
+                        return {
+                                "queued": queued,
+                                "tokens": round(self.bucket.available(time.monotonic()), 2),
+                                "waits": {PRIORITY_NAMES.get(priority, str(priority)): stats.as_dict() for priority, stats in sorted(self.waits.items())},
+                        }
+
+
+class RateLimiter(object):
+        """
+        Token bucket per Domoticz server with a priority queue in front of it, so a burst of status
+        polls can't hold up a power off from gcode. Requests of the same priority are sent in the
+        order they arrived. A rate of 0 disables limiting.
+        """
+
+        def __init__(self, rate=0, burst=1, metrics=None):
+                self._rate = rate
+                self._burst = burst
+                self._metrics = metrics
+                self._servers = {}
+                self._tickets = itertools.count()
+                self._lock = threading.Lock()
+
+        @property
+        def enabled(self):
+                return self._rate > 0
+
+        def configure(self, rate, burst):
+                with self._lock:
+                        self._rate = rate
+                        self._burst = burst
+                        servers, self._servers = list(self._servers.values()), {}
+                # requests waiting on the old limits go ahead
+                for queue in servers:
+                        queue.close()
+
+        def acquire(self, server, priority=None):
+                """Blocks until the request may be sent to ``server`` and returns the seconds it waited."""
+                if self._rate <= 0:
+                        return 0.0
+                if priority is None:
+                        priority = request_priority.get()
+                queue = self._servers.get(server)
+                if queue is None:
+                        with self._lock:
+                                queue = self._servers.setdefault(server, _ServerQueue(self._rate, self._burst))
+                waited = queue.acquire(priority, next(self._tickets))
+                if self._metrics is not None:
+                        self._metrics.rate_limit_wait.observe(waited, server, PRIORITY_NAMES.get(priority, str(priority)))
+                return waited
+
+        def queued(self):
+                return sum(len(queue.waiting) for queue in list(self._servers.values()))
+
+        def stats(self):
+                return {server: queue.as_dict() for server, queue in list(self._servers.items())}
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import contextvars
+import itertools
+import logging
+import re
+
+REDACTED = "***"
+
+# keys of api payloads and settings holding secrets
+SECRET_KEYS = frozenset(("password", "passcode", "apikey", "api_key", "token", "authorization"))
+
+_SECRET_PARAMS = re.compile(r"\b(password|passcode|apikey|api_key|token)=[^&\s'\"]*", re.IGNORECASE)
+_URL_CREDENTIALS = re.compile(r"(://[^:/@\s]+):[^@/\s]+@")
+_SECRET_ITEMS = re.compile(r"(['\"](?:%s)['\"]\s*:\s*)(['\"]).*?\2" % "|".join(SECRET_KEYS), re.IGNORECASE)
+
+correlation_id = contextvars.ContextVar("domoticz_correlation_id", default=None)
+_correlation_ids = itertools.count(1)
+
+
+def new_correlation_id(prefix):
+        """
+        Tags everything logged from here on in this context, including work handed to the plugin's pools.
+        Returns a token for reset_correlation_id, callers on OctoPrint's threads reset it when they are done.
+        """
+        return correlation_id.set(f"{prefix}-{next(_correlation_ids)}")
+
+
+def reset_correlation_id(token):
+        correlation_id.reset(token)
+
+
+def redact(value):
+        if isinstance(value, dict):
+                return {
+                        key: REDACTED if str(key).lower() in SECRET_KEYS and item else redact(item)
+                        for key, item in value.items()
+                }
+        if isinstance(value, (list, tuple)):
+                return type(value)(redact(item) for item in value)
+        if isinstance(value, str):
+                value = _SECRET_PARAMS.sub(lambda m: f"{m.group(1)}={REDACTED}", value)
+                value = _URL_CREDENTIALS.sub(lambda m: f"{m.group(1)}:{REDACTED}@", value)
+                return _SECRET_ITEMS.sub(lambda m: f"{m.group(1)}{m.group(2)}{REDACTED}{m.group(2)}", value)
+        if value is None or isinstance(value, (bool, int, float)):
+                return value
+        # exceptions and responses render the requested url, passcode included
+        return redact(str(value))
+
+
+class RedactingFilter(logging.Filter):
+        """
+        Redacts credentials and adds the correlation id of the current context. Attached to the
+        plugin's loggers it only runs for records passing the level check, so debug calls cost a
+        cached level lookup while debug logging is off and their arguments are never formatted.
+        """
+
+        def filter(self, record):
+                if record.args:
+                        record.args = tuple(redact(arg) for arg in record.args) if isinstance(record.args, tuple) else redact(record.args)
+                if isinstance(record.msg, str):
+                        record.msg = redact(record.msg)
+                value = correlation_id.get()
+                record.correlation = f"[{value}] " if value else ""
+                return True
+
+
+LOG_FILTER = RedactingFilter()
+
+
+class DeferredHandler(logging.Handler):
+        """
+        Stands in for a handler that is expensive to set up, e.g. a rotating log file, and builds it
+        from ``factory`` when the first record reaches it. Plugins that never log anything above the
+        logger's level never create the file.
+        """
+
+        def __init__(self, factory, level=logging.NOTSET):
+                logging.Handler.__init__(self, level)
+                self._factory = factory
+                self._handler = None
+
+        def emit(self, record):
+                # handle() holds the handler lock around emit, the target is created only once
+                if self._handler is None:
+                        self._handler = self._factory()
+                        self._handler.setFormatter(self.formatter)
+                self._handler.handle(record)
+
+        def close(self):
+                try:
+                        if self._handler is not None:
+                                self._handler.close()
+                finally:
+                        logging.Handler.close(self)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=None):
+        pairs = list(zip(names, values))
+        if extra:
+                pairs.append(extra)
+        if not pairs:
+                return ""
+        escaped = (
+                '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                for name, value in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+        if value == float("inf"):
+                return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+        def __init__(self, name, documentation, labels=()):
+                self.name = name
+                self.documentation = documentation
+                self.labels = tuple(labels)
+                self._values = {}
+                self._lock = threading.Lock()
+
+        def inc(self, *labels, amount=1):
+                with self._lock:
+                        self._values[labels] = self._values.get(labels, 0) + amount
+
+        def collect(self):
+                lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+                with self._lock:
+                        values = list(self._values.items())
+                for labels, value in sorted(values):
+                        lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+                return lines
+
+
+class Histogram(object):
+        def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+                self.name = name
+                self.documentation = documentation
+                self.labels = tuple(labels)
+                self.buckets = tuple(buckets)
+                self._values = {}
+                self._lock = threading.Lock()
+
+        def observe(self, value, *labels):
+                index = bisect.bisect_left(self.buckets, value)
+                with self._lock:
+                        entry = self._values.get(labels)
+                        if entry is None:
+                                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                        entry[0][index] += 1
+                        entry[1] += value
+                        entry[2] += 1
+
+        def collect(self):
+                lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+                with self._lock:
+                        values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self._values.items()]
+                for labels, counts, total, count in sorted(values):
+                        cumulative = 0
+                        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                                cumulative += bucket_count
+                                le = ("le", _format_value(bound) if bound != float("inf") else "+Inf")
+                                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+                        lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+                        lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+                return lines
+
+
+class Gauge(object):
+        """Gauge read from a callback at scrape time, nothing to update on the hot paths."""
+
+        def __init__(self, name, documentation, callback):
+                self.name = name
+                self.documentation = documentation
+                self.callback = callback
+
+        def collect(self):
+                return [
+                        f"# HELP {self.name} {self.documentation}",
+                        f"# TYPE {self.name} gauge",
+                        f"{self.name} {_format_value(self.callback())}",
+                ]
+
+
+class GcodeHookStats(object):
+        """
+        Time spent on gcode lines passing the prefix test of the queuing hook. The hook runs on the
+        single comm thread, so the totals are plain attributes without a lock, and lines rejected by
+        the prefix test are not timed at all.
+        """
+
+        def __init__(self):
+                self.seconds = 0.0
+                self.commands = 0
+
+        def record(self, seconds):
+                self.seconds += seconds
+                self.commands += 1
+
+
+class DomoticzMetrics(object):
+        def __init__(self):
+                self.request_duration = Histogram(
+                        "domoticz_request_duration_seconds",
+                        "Latency of requests to Domoticz servers.",
+                        labels=("server", "command"),
+                )
+                self.requests = Counter(
+                        "domoticz_requests_total",
+                        "Requests to Domoticz servers by result.",
+                        labels=("server", "command", "result"),
+                )
+                self.rate_limit_wait = Histogram(
+                        "domoticz_rate_limit_wait_seconds",
+                        "Time requests waited for the rate limit of their Domoticz server.",
+                        labels=("server", "priority"),
+                        buckets=(0.0, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+                )
+                self.coalesced = Counter(
+                        "domoticz_coalesced_total",
+                        "Requests saved by sharing a request in flight or dropping superseded switch commands.",
+                        labels=("kind",),
+                )
+                self.gcode = GcodeHookStats()
+                self._gauges = []
+
+        def add_gauge(self, name, documentation, callback):
+                self._gauges.append(Gauge(name, documentation, callback))
+
+        def observe_request(self, server, command, result, seconds=None):
+                if seconds is not None:
+                        self.request_duration.observe(seconds, server, command)
+                self.requests.inc(server, command, result)
+
+        def render(self):
+                lines = self.request_duration.collect() + self.requests.collect() + self.coalesced.collect()
+                lines += self.rate_limit_wait.collect()
+                lines += [
+                        "# HELP domoticz_gcode_hook_seconds_total Time spent in the gcode hook on candidate power commands.",
+                        "# TYPE domoticz_gcode_hook_seconds_total counter",
+                        f"domoticz_gcode_hook_seconds_total {_format_value(self.gcode.seconds)}",
+                        "# HELP domoticz_gcode_commands_total Gcode lines matching the power command prefixes.",
+                        "# TYPE domoticz_gcode_commands_total counter",
+                        f"domoticz_gcode_commands_total {self.gcode.commands}",
+                ]
+                for gauge in self._gauges:
+                        lines += gauge.collect()
+                return "\n".join(lines) + "\n"
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from .state import plug_key
+
+
+class PlugEntry(object):
+        """A configured plug with the parameters of its requests worked out once."""
+
+        __slots__ = ("plug", "key", "auth", "verify", "passcode", "switch_queries", "status_query")
+
+        def __init__(self, plug):
+                self.plug = plug
+                self.key = plug_key(plug["ip"], plug["idx"])
+                self.auth = (plug["username"], plug["password"]) if plug.get("username") else None
+                self.verify = not plug.get("ignoreSSL", False)
+                self.passcode = plug.get("passcode", "")
+
+                scene = plug.get("type") == "scene"
+                switch = f"type=command&param={'switchscene' if scene else 'switchlight'}&idx={plug['idx']}&switchcmd="
+                passcode = f"&passcode={self.passcode}" if self.passcode else ""
+                self.switch_queries = {command: f"{switch}{command}{passcode}" for command in ("On", "Off")}
+                # getscenes has no filter for a single scene, the scene is picked from the list
+                self.status_query = "type=command&param=getscenes" if scene else f"type=command&param=getdevices&rid={plug['idx']}"
+
+        def switch_query(self, command, passcode):
+                """The switch query for ``command``, None if ``passcode`` differs from the configured one."""
+                return self.switch_queries.get(command) if passcode == self.passcode else None
+
+        @property
+        def username(self):
+                return self.auth[0] if self.auth else ""
+
+        @property
+        def password(self):
+                return self.auth[1] if self.auth else ""
+
+
+class PlugRegistry(object):
+        """
+        The configured plugs indexed by normalized (ip, idx), built from the settings on first use
+        and dropped whenever they change, so lookups don't walk and copy the settings tree.
+        """
+
+        def __init__(self, load):
+                self._load = load
+                self._entries = None
+
+        def invalidate(self):
+                self._entries = None
+
+        def entries(self):
+                entries = self._entries
+                if entries is None:
+                        # first configured plug wins for duplicates, like a linear search did
+                        entries = {}
+                        for plug in self._load() or []:
+                                entry = PlugEntry(plug)
+                                entries.setdefault(entry.key, entry)
+                        self._entries = entries
+                return entries
+
+        def get(self, ip, idx):
+                return self.entries().get(plug_key(ip or "", idx or ""))
+
+        def plug(self, ip, idx):
+                entry = self.get(ip, idx)
+                return entry.plug if entry is not None else None
+
+        def plugs(self):
+                return [entry.plug for entry in self.entries().values()]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class _Action(object):
+        __slots__ = ("id", "due", "fn", "args", "kwargs", "key", "label", "cancelled", "context", "on_cancel", "inline")
+
+        def __init__(self, action_id, due, fn, args, kwargs, key, label, on_cancel=None, inline=False):
+                self.id = action_id
+                self.due = due
+                self.fn = fn
+                self.args = args
+                self.kwargs = kwargs
+                self.key = key
+                self.label = label
+                self.cancelled = False
+                self.on_cancel = on_cancel
+                self.inline = inline
+                # runs in the context it was scheduled from, e.g. with the correlation id of its request
+                self.context = contextvars.copy_context()
+
+        def __lt__(self, other):
+                return (self.due, self.id) < (other.due, other.id)
+
+        def cancel(self):
+                self.cancelled = True
+                if self.on_cancel is not None:
+                        self.on_cancel()
+
+
+class ActionScheduler(object):
+        """
+        Single thread running delayed actions off a heap, replacing one threading.Timer per action.
+
+        Due actions are handed to ``submit`` so a slow action never holds up the ones behind it.
+        Actions scheduled with a key supersede a still pending action with the same key, which is
+        how a pending power off gets replaced by a later power on of the same plug. ``on_cancel`` is
+        called with the scheduler's lock held when an action is cancelled, superseded or dropped by
+        stop, it must not block. ``inline`` actions run on the scheduler thread, for actions that only
+        release a waiting thread and must not queue behind busy workers.
+        """
+
+        def __init__(self, submit, name="domoticz.scheduler", logger=None):
+                self._submit = submit
+                self._name = name
+                self._logger = logger or logging.getLogger(__name__)
+                self._heap = []
+                self._pending = {}
+                self._ids = itertools.count(1)
+                self._cond = threading.Condition()
+                self._thread = None
+                self._stopped = False
+
+        def schedule(self, delay, fn, args=(), kwargs=None, key=None, label=None, on_cancel=None, inline=False):
+                action = _Action(
+                        next(self._ids),
+                        time.monotonic() + max(0, delay),
+                        fn,
+                        tuple(args),
+                        kwargs or {},
+                        key,
+                        label or getattr(fn, "__name__", "action"),
+                        on_cancel,
+                        inline,
+                )
+                with self._cond:
+                        if key is not None:
+                                self._cancel_locked(key)
+                                self._pending[key] = action
+                        heapq.heappush(self._heap, action)
+                        self._ensure_thread()
+                        self._cond.notify()
+                return action.id
+
+        def cancel(self, key):
+                with self._cond:
+                        return self._cancel_locked(key)
+
+        def cancel_id(self, action_id):
+                with self._cond:
+                        for action in self._heap:
+                                if action.id == action_id and not action.cancelled:
+                                        action.cancel()
+                                        if action.key is not None:
+                                                self._pending.pop(action.key, None)
+                                        return True
+                return False
+
+        def pending(self):
+                now = time.monotonic()
+                with self._cond:
+                        actions = sorted(action for action in self._heap if not action.cancelled)
+                return [
+                        {
+                                "id": action.id,
+                                "label": action.label,
+                                "key": list(action.key) if action.key is not None else None,
+                                "due_in": round(max(0, action.due - now), 3),
+                        }
+                        for action in actions
+                ]
+
+        def size(self):
+                return len(self._pending) + sum(1 for action in self._heap if action.key is None and not action.cancelled)
+
+        def stop(self):
+                with self._cond:
+                        self._stopped = True
+                        for action in self._heap:
+                                if not action.cancelled:
+                                        action.cancel()
+                        self._heap = []
+                        self._pending = {}
+                        self._cond.notify()
+
+        def _cancel_locked(self, key):
+                action = self._pending.pop(key, None)
+                if action is None:
+                        return False
+                action.cancel()
+                return True
+
+        def _ensure_thread(self):
+                if not self._stopped and (self._thread is None or not self._thread.is_alive()):
+                        self._thread = threading.Thread(target=self._run, name=self._name)
+                        self._thread.daemon = True
+                        self._thread.start()
+
+        def _run(self):
+                while True:
+                        with self._cond:
+                                action = None
+                                while action is None:
+                                        if self._stopped:
+                                                return
+                                        if not self._heap:
+                                                self._cond.wait()
+                                                continue
+                                        head = self._heap[0]
+                                        if head.cancelled:
+                                                heapq.heappop(self._heap)
+                                                continue
+                                        remaining = head.due - time.monotonic()
+                                        if remaining > 0:
+                                                self._cond.wait(remaining)
+                                                continue
+                                        action = heapq.heappop(self._heap)
+                                        if action.key is not None and self._pending.get(action.key) is action:
+                                                del self._pending[action.key]
+
+                        try:
+                                if action.inline:
+                                        action.context.run(action.fn, *action.args, **action.kwargs)
+                                else:
+                                        action.context.run(self._submit, action.fn, *action.args, **action.kwargs)
+                        except Exception:
+                                self._logger.exception("Could not run scheduled action %s.", action.label)
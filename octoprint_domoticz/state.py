@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+def plug_key(ip, idx):
+        return ip.rstrip("/").upper(), str(idx)
+
+
+class StateCache(object):
+        """
+        In-memory plug state shared by the poller, the api handlers and every connected browser,
+        keyed by normalized (ip, idx) with the time the state was last confirmed.
+        """
+
+        def __init__(self):
+                self._states = {}
+                self._lock = threading.Lock()
+
+        def update(self, ip, idx, state, timestamp=None):
+                """Stores the state and returns True if it differs from the previously known one."""
+                if timestamp is None:
+                        timestamp = time.time()
+                key = plug_key(ip, idx)
+                with self._lock:
+                        previous = self._states.get(key)
+                        self._states[key] = {"ip": ip, "idx": idx, "currentState": state, "timestamp": timestamp}
+                return previous is None or previous["currentState"] != state
+
+        def get(self, ip, idx, max_age=None):
+                """Returns the cached state, or None if it is unknown or older than max_age seconds."""
+                entry = self._states.get(plug_key(ip, idx))
+                if entry is None:
+                        return None
+                if max_age is not None and time.time() - entry["timestamp"] > max_age:
+                        return None
+                return entry["currentState"]
+
+        def snapshot(self):
+                with self._lock:
+                        return [dict(entry) for entry in self._states.values()]
+
+        def clear(self):
+                with self._lock:
+                        self._states = {}
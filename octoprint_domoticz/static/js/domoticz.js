@@ -16,7 +16,10 @@ $(function() {
 		self.gcodeOnString = function(data){return 'M80 '+data.ip()+' '+data.idx();};
 		self.gcodeOffString = function(data){return 'M81 '+data.ip()+' '+data.idx();};
 		self.selectedPlug = ko.observable();
+		self.selectedGroup = ko.observable();
 		self.processing = ko.observableArray([]);
+		self.plugStates = {};
+		self.plugPowers = {};
 
 		self.onBeforeBinding = function() {
 			self.arrSmartplugs(self.settings.settings.plugins.domoticz.arrSmartplugs());
@@ -41,6 +44,7 @@ $(function() {
 
 		self.addPlug = function() {
 			self.selectedPlug({'ip':ko.observable(''),
+							   'type':ko.observable('device'),
 							   'idx':ko.observable('1'),
 							   'displayWarning':ko.observable(true),
 							   'ignoreSSL':ko.observable(false),
@@ -58,7 +62,8 @@ $(function() {
 							   'sysCmdOff':ko.observable(false),
 							   'sysRunCmdOff':ko.observable(''),
 							   'sysCmdOffDelay':ko.observable(0),
-							   'currentState':ko.observable('unknown'),
+							   'idleOff':ko.observable(false),
+							   'idleTimeout':ko.observable(30),
 							   'btnColor':ko.observable('#808080'),
 							   'username':ko.observable(''),
 							   'password':ko.observable(''),
@@ -78,6 +83,36 @@ $(function() {
 			self.settings.settings.plugins.domoticz.arrSmartplugs.remove(row);
 		}
 
+		self.addGroup = function() {
+			self.selectedGroup({'name':ko.observable(''),
+								'gcodeEnabled':ko.observable(true),
+								'members':ko.observableArray([])});
+			self.settings.settings.plugins.domoticz.arrGroups.push(self.selectedGroup());
+			$("#DomoticzGroupEditor").modal("show");
+		}
+
+		self.editGroup = function(data) {
+			self.selectedGroup(data);
+			$("#DomoticzGroupEditor").modal("show");
+		}
+
+		self.removeGroup = function(row) {
+			self.settings.settings.plugins.domoticz.arrGroups.remove(row);
+		}
+
+		self.addGroupMember = function() {
+			self.selectedGroup().members.push({'ip':ko.observable(''),
+											   'idx':ko.observable('1'),
+											   'stage':ko.observable(0)});
+		}
+
+		self.removeGroupMember = function(row) {
+			self.selectedGroup().members.remove(row);
+		}
+
+		self.gcodeGroupOnString = function(data){return '@DOMOTICZGROUPON '+data.name();};
+		self.gcodeGroupOffString = function(data){return '@DOMOTICZGROUPOFF '+data.name();};
+
 		self.cancelClick = function(data) {
 			self.processing.remove(data.ip());
 		}
@@ -87,39 +122,123 @@ $(function() {
 				return;
 			}
 
-			plug = ko.utils.arrayFirst(self.settings.settings.plugins.domoticz.arrSmartplugs(),function(item){
-				return ((item.ip().toUpperCase() == data.ip.toUpperCase()) && (item.idx() == data.idx));
-				}) || {'ip':data.ip,'idx':data.idx,'currentState':'unknown','btnColor':'#808080','gcodeEnabled':false};
-
 			if(self.settings.settings.plugins.domoticz.debug_logging()){
-				console.log(self.settings.settings.plugins.domoticz.arrSmartplugs());
-				console.log('msg received:'+JSON.stringify(data));
-				console.log('plug data:'+ko.toJSON(plug));
+				console.log('msg received: ' + (data.states ? data.states.length + ' states' : JSON.stringify(data)));
+			}
+
+			if (data.sysCmd) {
+				self.reportSystemCommand(data.sysCmd);
+				return;
+			}
+
+			if (data.group) {
+				self.reportGroup(data.group);
+				return;
 			}
 
-			if (plug.currentState != data.currentState) {
-				plug.currentState(data.currentState)
-				switch(data.currentState) {
-					case "on":
-						break;
-					case "off":
-						break;
-					default:
-						new PNotify({
-							title: 'Domoticz Error',
-							text: 'Status ' + plug.currentState() + ' for ' + plug.ip() + '. Double check IP Address\\Hostname in Domoticz Settings.',
-							type: 'error',
-							hide: true
-							});
+			if (data.power) {
+				ko.utils.arrayForEach(data.power, function(reading) {
+					self.powerObservable(reading.ip, reading.idx)(reading.power);
+				});
+				return;
+			}
+
+			if (data.job) {
+				return;
+			}
+
+			self.applyStates(data.states || [data]);
+		};
+
+		// plug states are runtime only and never saved with the settings
+		self.stateObservable = function(ip, idx) {
+			var key = ip.toUpperCase() + '|' + idx;
+			if (!self.plugStates[key]) {
+				// deferred so a batch of states re-renders the navbar once
+				self.plugStates[key] = ko.observable('unknown').extend({deferred: true});
+			}
+			return self.plugStates[key];
+		};
+
+		self.plugState = function(data) {
+			return self.stateObservable(data.ip(), data.idx())();
+		};
+
+		self.powerObservable = function(ip, idx) {
+			var key = ip.toUpperCase() + '|' + idx;
+			if (!self.plugPowers[key]) {
+				self.plugPowers[key] = ko.observable(null);
+			}
+			return self.plugPowers[key];
+		};
+
+		self.plugTitle = function(data) {
+			var power = self.powerObservable(data.ip(), data.idx())();
+			return data.label() + (power === null ? '' : ' (' + power + ' W)');
+		};
+
+		self.applyStates = function(states) {
+			var unknown = [];
+			var done = {};
+			var debug = self.settings.settings.plugins.domoticz.debug_logging();
+
+			ko.utils.arrayForEach(states, function(data) {
+				var state = self.stateObservable(data.ip, data.idx);
+				if (debug) {
+					console.log('plug ' + data.ip + ' index ' + data.idx + ': ' + state() + ' -> ' + data.currentState);
+				}
+				state(data.currentState);
+				if (data.currentState !== "on" && data.currentState !== "off") {
+					unknown.push(data.ip + ' index ' + data.idx);
 				}
-				self.settings.saveData();
+				done[data.ip] = true;
+			});
+
+			// a single change notification for the whole batch
+			self.processing.remove(function(ip) {
+				return done[ip];
+			});
+			if (unknown.length) {
+				new PNotify({
+					title: 'Domoticz Error',
+					text: 'Status unknown for ' + unknown.join(', ') + '. Double check IP Address\\Hostname in Domoticz Settings.',
+					type: 'error',
+					hide: true
+					});
+			}
+		};
+
+		self.reportSystemCommand = function(result) {
+			if (result.timedOut || result.returncode !== 0) {
+				new PNotify({
+					title: 'Domoticz Error',
+					text: 'System command for ' + result.ip + ' index ' + result.idx + (result.timedOut ? ' timed out after ' + result.duration + 's.' : ' exited with ' + result.returncode + '.'),
+					type: 'error',
+					hide: true
+					});
+			}
+		};
+
+		// member states already arrived as plug messages, only failures need reporting
+		self.reportGroup = function(result) {
+			if (!result.ok) {
+				var failed = ko.utils.arrayFilter(result.results, function(member) {
+					return member.currentState !== result.action;
+				});
+				new PNotify({
+					title: 'Domoticz Error',
+					text: 'Group ' + result.name + ' could not switch ' + result.action + (failed.length ? ': ' + ko.utils.arrayMap(failed, function(member) {
+						return member.ip + ' index ' + member.idx;
+					}).join(', ') : '.'),
+					type: 'error',
+					hide: true
+					});
 			}
-			self.processing.remove(data.ip);
 		};
 
 		self.toggleRelay = function(data) {
 			self.processing.push(data.ip());
-			switch(data.currentState()){
+			switch(self.plugState(data)){
 				case "on":
 					self.turnOff(data);
 					break;
@@ -179,6 +298,19 @@ $(function() {
 			});
 		}
 
+		self.switchGroup = function(data, on) {
+			$.ajax({
+				url: API_BASEURL + "plugin/domoticz",
+				type: "POST",
+				dataType: "json",
+				data: JSON.stringify({
+					command: on ? "turnOnGroup" : "turnOffGroup",
+					name: data.name()
+				}),
+				contentType: "application/json; charset=UTF-8"
+			});
+		};
+
 		self.checkStatus = function(data) {
 			$.ajax({
 				url: API_BASEURL + "plugin/domoticz",
@@ -192,9 +324,7 @@ $(function() {
 					password: data.password()
 				}),
 				contentType: "application/json; charset=UTF-8"
-			}).done(function(){
-				self.settings.saveData();
-				});
+			});
 		};
 
 		self.disconnectPrinter = function() {
@@ -222,13 +352,17 @@ $(function() {
 		}
 
 		self.checkStatuses = function() {
-			ko.utils.arrayForEach(self.settings.settings.plugins.domoticz.arrSmartplugs(),function(item){
-				if(item.ip() !== "") {
-					if(self.settings.settings.plugins.domoticz.debug_logging()){
-						console.log("checking " + item.ip() + " index " + item.idx());
-					}
-					self.checkStatus(item);
-				}
+			if(self.settings.settings.plugins.domoticz.debug_logging()){
+				console.log("checking all plugs");
+			}
+			$.ajax({
+				url: API_BASEURL + "plugin/domoticz",
+				type: "POST",
+				dataType: "json",
+				data: JSON.stringify({
+					command: "checkAllStatuses"
+				}),
+				contentType: "application/json; charset=UTF-8"
 			});
 		};
 	}
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import collections
+import math
+import re
+import threading
+from array import array
+
+from .state import plug_key
+
+_NUMBER = r"(-?\d+(?:\.\d+)?)"
+_WATT = re.compile(_NUMBER + r"\s*Watt", re.IGNORECASE)
+_KWH = re.compile(_NUMBER + r"\s*kWh", re.IGNORECASE)
+
+MISSING = float("nan")
+
+
+def parse_reading(device):
+        """
+        Power in watt and energy counter in kWh of a getdevices result entry, None where the device
+        doesn't report it. Energy devices put the power in Usage and the counter in Data, combined
+        devices report both in Data as "12.3 Watt, 1.234 kWh".
+        """
+        power = energy = None
+        for field in ("Usage", "Data"):
+                text = device.get(field)
+                if not isinstance(text, str):
+                        continue
+                if power is None:
+                        match = _WATT.search(text)
+                        if match:
+                                power = float(match.group(1))
+                if energy is None:
+                        match = _KWH.search(text)
+                        if match:
+                                energy = float(match.group(1))
+        return power, energy
+
+
+def _value(number):
+        return None if math.isnan(number) else number
+
+
+class RingBuffer(object):
+        """
+        Fixed capacity sample store backed by flat double arrays, so a plug costs the same 24 bytes
+        per slot whether it was sampled for an hour or a month. Missing readings are stored as NaN.
+        """
+
+        def __init__(self, capacity):
+                self.capacity = capacity
+                self._time = array("d", bytes(8 * capacity))
+                self._power = array("d", bytes(8 * capacity))
+                self._energy = array("d", bytes(8 * capacity))
+                self._next = 0
+                self._count = 0
+
+        def __len__(self):
+                return self._count
+
+        def append(self, timestamp, power, energy):
+                self._time[self._next] = timestamp
+                self._power[self._next] = MISSING if power is None else power
+                self._energy[self._next] = MISSING if energy is None else energy
+                self._next = (self._next + 1) % self.capacity
+                self._count = min(self._count + 1, self.capacity)
+
+        def last(self):
+                """The most recent (time, power, energy) sample, None while empty."""
+                if not self._count:
+                        return None
+                i = (self._next - 1) % self.capacity
+                return self._time[i], self._power[i], self._energy[i]
+
+        def samples(self, since=None):
+                start = (self._next - self._count) % self.capacity
+                result = []
+                for offset in range(self._count):
+                        i = (start + offset) % self.capacity
+                        if since is None or self._time[i] >= since:
+                                result.append((self._time[i], self._power[i], self._energy[i]))
+                return result
+
+        def downsample(self, points, since=None):
+                """Averages power over equal sized buckets of samples, keeping the last energy reading of each."""
+                samples = self.samples(since)
+                if points <= 0 or len(samples) <= points:
+                        return [[t, _value(power), _value(energy)] for t, power, energy in samples]
+
+                size = len(samples) / points
+                result = []
+                for n in range(points):
+                        bucket = samples[int(n * size):int((n + 1) * size)]
+                        if not bucket:
+                                continue
+                        powers = [power for _, power, _ in bucket if not math.isnan(power)]
+                        energies = [energy for _, _, energy in bucket if not math.isnan(energy)]
+                        result.append([
+                                bucket[-1][0],
+                                sum(powers) / len(powers) if powers else None,
+                                energies[-1] if energies else None,
+                        ])
+                return result
+
+
+class PlugEnergy(object):
+        """Running totals of one plug during a print job, updated with every sample."""
+
+        def __init__(self):
+                self.first_energy = None
+                self.last_energy = None
+                self.integrated_kwh = 0.0
+                self.peak_power = None
+                self.power_sum = 0.0
+                self.power_count = 0
+                self._last = None
+
+        def add(self, timestamp, power, energy):
+                if energy is not None:
+                        if self.first_energy is None:
+                                self.first_energy = energy
+                        self.last_energy = energy
+                if power is None:
+                        return
+                if self._last is not None:
+                        # trapezoidal integration for plugs without a kWh counter
+                        last_time, last_power = self._last
+                        self.integrated_kwh += (power + last_power) / 2 * max(0.0, timestamp - last_time) / 3600000
+                self._last = (timestamp, power)
+                self.peak_power = power if self.peak_power is None else max(self.peak_power, power)
+                self.power_sum += power
+                self.power_count += 1
+
+        def as_dict(self):
+                if self.first_energy is not None and self.last_energy is not None and self.last_energy >= self.first_energy:
+                        energy = self.last_energy - self.first_energy
+                        source = "counter"
+                else:
+                        energy = self.integrated_kwh
+                        source = "power"
+                return {
+                        "energy_kwh": round(energy, 4),
+                        "energy_source": source,
+                        "average_w": round(self.power_sum / self.power_count, 1) if self.power_count else None,
+                        "peak_w": self.peak_power,
+                }
+
+
+class Telemetry(object):
+        """
+        Power and energy samples per plug plus energy totals of the running and the last few print
+        jobs. Samples are recorded from the status poller thread while the api and event handlers read
+        from others, so every access goes through one lock.
+        """
+
+        def __init__(self, capacity=1440, max_jobs=20):
+                self.capacity = capacity
+                self._buffers = {}
+                self._labels = {}
+                self._job = None
+                self._jobs = collections.deque(maxlen=max_jobs)
+                self._lock = threading.Lock()
+
+        def configure(self, capacity, max_jobs):
+                with self._lock:
+                        if capacity != self.capacity:
+                                self._buffers = {}
+                        self.capacity = capacity
+                        self._jobs = collections.deque(self._jobs, maxlen=max_jobs)
+
+        def record(self, plug, timestamp, power, energy):
+                key = plug_key(plug["ip"], plug["idx"])
+                with self._lock:
+                        buffer = self._buffers.get(key)
+                        if buffer is None:
+                                buffer = self._buffers[key] = RingBuffer(self.capacity)
+                        buffer.append(timestamp, power, energy)
+                        self._labels[key] = (plug["ip"], plug["idx"], plug.get("label", ""))
+                        if self._job is not None:
+                                self._job["plugs"].setdefault(key, PlugEnergy()).add(timestamp, power, energy)
+
+        def start_job(self, name, timestamp):
+                with self._lock:
+                        self._job = {"name": name, "start": timestamp, "plugs": {}}
+
+        def finish_job(self, outcome, timestamp):
+                with self._lock:
+                        job, self._job = self._job, None
+                        if job is None:
+                                return None
+                        report = self._job_report(job, outcome, timestamp)
+                        self._jobs.append(report)
+                return report
+
+        def series(self, points, since=None, ip=None, idx=None):
+                wanted = plug_key(ip, idx) if ip is not None and idx is not None else None
+                with self._lock:
+                        result = []
+                        for key, buffer in self._buffers.items():
+                                if wanted is not None and key != wanted:
+                                        continue
+                                ip_, idx_, label = self._labels[key]
+                                result.append({
+                                        "ip": ip_,
+                                        "idx": idx_,
+                                        "label": label,
+                                        "samples": buffer.downsample(points, since),
+                                })
+                return result
+
+        def latest(self):
+                with self._lock:
+                        result = []
+                        for key, buffer in self._buffers.items():
+                                sample = buffer.last()
+                                if sample is not None:
+                                        ip, idx, _ = self._labels[key]
+                                        result.append({"ip": ip, "idx": idx, "power": _value(sample[1])})
+                return result
+
+        def jobs(self):
+                with self._lock:
+                        jobs = list(self._jobs)
+                        if self._job is not None:
+                                jobs.append(self._job_report(self._job, "printing", None))
+                return jobs
+
+        def _job_report(self, job, outcome, timestamp):
+                plugs = []
+                for key, energy in job["plugs"].items():
+                        ip, idx, label = self._labels[key]
+                        plugs.append(dict(energy.as_dict(), ip=ip, idx=idx, label=label))
+                return {
+                        "name": job["name"],
+                        "outcome": outcome,
+                        "start": job["start"],
+                        "end": timestamp,
+                        "energy_kwh": round(sum(plug["energy_kwh"] for plug in plugs), 4),
+                        "plugs": plugs,
+                }